@@ -0,0 +1,279 @@
+import argparse
+import atexit
+import asyncio
+import json
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 基准测试：在临时目录中生成合成的 content.db，分别通过 Flask 测试客户端和原生 ASGI 应用 main
+# 并发请求各个路由，输出每秒请求数和 p50/p95/p99 延迟，并可与保存的基准结果比较
+
+SCENARIOS = ('note', 'main', 'update', 'update_patch', 'create_share', 'create_burn', 'share', 'burn')
+TRANSPORTS = ('flask', 'asgi')
+# 默认的基准文件，位于 bench.py 所在目录；结果与机器相关，不提交到仓库
+DEFAULT_BASELINE = 'bench-baseline.json'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='JustGetMyNote HTTP benchmark')
+    parser.add_argument('--notes', type=int, default=2000, help='合成数据库中的笔记数')
+    parser.add_argument('--size', type=int, default=2000, help='每篇笔记的字符数')
+    parser.add_argument('--shared', type=float, default=0.1, help='创建了共享链接的笔记比例')
+    parser.add_argument('--requests', type=int, default=2000, help='每个场景的请求数')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发请求数')
+    parser.add_argument('--transport', choices=TRANSPORTS + ('both',), default='both')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='只运行指定场景，可重复')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--rate-limits', action='store_true', help='保留 settings 中默认的按 IP 限流')
+    parser.add_argument('--output', help='把结果写入该 JSON 文件')
+    parser.add_argument('--baseline', help=f'与该 JSON 文件中的基准结果比较，退化超过容差时以非零状态退出（默认为 {DEFAULT_BASELINE}，存在时自动比较）')
+    parser.add_argument('--save-baseline', action='store_true', help='把本次结果保存为基准文件，不做比较')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允许的退化比例（0.2 表示 20%%）')
+    return parser.parse_args()
+
+def random_text(rng, size):
+    alphabet = string.ascii_letters + string.digits + '     \n'
+    return ''.join(rng.choice(alphabet) for _ in range(size))
+
+# 通过 server 自身的写入路径生成合成数据，然后清空缓存，让读取从冷缓存开始
+def build_dataset(server, args, rng):
+    identifiers = [f'n{i}' for i in range(args.notes)]
+    writes = {}
+    for identifier in identifiers:
+        writes[identifier] = random_text(rng, args.size)
+        if len(writes) >= server.WRITE_BATCH_SIZE:
+            server.flush_writes(writes)
+            writes = {}
+    if writes:
+        server.flush_writes(writes)
+    shared = identifiers[:int(len(identifiers) * args.shared)]
+    share_ids = [server.generate_share_id() for _ in shared]
+    # 分片模式下每篇笔记的 share_id 写入它所在的分片
+    rows = {}
+    for share_id, identifier in zip(share_ids, shared):
+        rows.setdefault(server.shard_for(identifier), []).append((share_id, identifier))
+    for shard, shard_rows in rows.items():
+        with shard.pool.connection() as conn:
+            conn.executemany('UPDATE contents SET share_id = ? WHERE id = ?', shard_rows)
+            conn.commit()
+    server.reset_content_cache()
+    return identifiers, share_ids
+
+# 每个场景生成 (方法, 路径, 请求体) 列表；阅后即焚链接只能读取一次，需要预先为每个请求创建一个
+def build_requests(name, count, identifiers, share_ids, burn_urls, rng):
+    requests = []
+    for i in range(count):
+        identifier = rng.choice(identifiers)
+        if name == 'note':
+            requests.append(('GET', f'/{identifier}', None))
+        elif name == 'main':
+            requests.append(('GET', '/', None))
+        elif name == 'update':
+            requests.append(('POST', f'/update/{identifier}', {'content': f'bench update {i}'}))
+        elif name == 'update_patch':
+            # 基准哈希在发送前读取；按顺序轮流选择笔记，并发的请求不会修改同一篇笔记而互相导致 409
+            requests.append(('PATCH', f'/update/{identifiers[i % len(identifiers)]}', None))
+        elif name == 'create_share':
+            requests.append(('POST', f'/create_share/{identifier}', None))
+        elif name == 'create_burn':
+            requests.append(('POST', f'/create_burn/{identifier}', None))
+        elif name == 'share':
+            requests.append(('GET', f'/share/{rng.choice(share_ids)}', None))
+        elif name == 'burn':
+            requests.append(('GET', burn_urls[i], None))
+    return requests
+
+# 增量更新的请求体：在当前内容末尾追加一个字符
+def patch_body(server, path):
+    identifier = path.rsplit('/', 1)[1]
+    entry = server.get_note(identifier)
+    content, digest = entry or ('', server.EMPTY_CONTENT_HASH)
+    return {'base': digest, 'patch': [len(content), len(content), 'x']}
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies, elapsed, errors):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+def run_flask(server, requests, concurrency):
+    local = threading.local()
+
+    def run_request(item):
+        method, path, body = item
+        # 每个线程使用自己的测试客户端
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = server.app.test_client()
+        if method == 'PATCH':
+            method, body = 'POST', patch_body(server, path)
+        start = time.perf_counter()
+        if method == 'GET':
+            response = client.get(path)
+        else:
+            response = client.post(path, json=body)
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(run_request, requests))
+    return results, time.perf_counter() - start
+
+async def asgi_call(app, method, path, body):
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    headers = [(b'host', b'localhost')]
+    if body is not None:
+        headers += [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode('latin-1'))]
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode('utf-8'), 'root_path': '',
+        'query_string': b'', 'headers': headers,
+        'client': ('127.0.0.1', 50000), 'server': ('localhost', 6094),
+    }
+    messages = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+    status = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        # 请求体发送完毕后不会再有消息，直到连接关闭
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await app(scope, receive, send)
+    return status[0]
+
+def run_asgi(server, requests, concurrency):
+    async def worker(queue_, results):
+        while queue_:
+            method, path, body = queue_.pop()
+            if method == 'PATCH':
+                method, body = 'POST', patch_body(server, path)
+            start = time.perf_counter()
+            status = await asgi_call(server.main, method, path, body)
+            results.append((time.perf_counter() - start, status))
+
+    async def run_all():
+        pending = list(reversed(requests))
+        results = []
+        await asyncio.gather(*(worker(pending, results) for _ in range(concurrency)))
+        return results
+
+    start = time.perf_counter()
+    results = asyncio.run(run_all())
+    return results, time.perf_counter() - start
+
+def create_burns(server, identifiers, count, rng):
+    client = server.app.test_client()
+    urls = []
+    for _ in range(count):
+        response = client.post(f'/create_burn/{rng.choice(identifiers)}')
+        urls.append(response.get_json()['burn_url'])
+    return urls
+
+# 返回 [(transport/scenario, 指标, 当前值, 基准值)]，吞吐下降或延迟上升超过容差的项
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        if current['rps'] < previous['rps'] * (1 - tolerance):
+            regressions.append((key, 'rps', current['rps'], previous['rps']))
+        for metric in ('p95_ms', 'p99_ms'):
+            if current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append((key, metric, current[metric], previous[metric]))
+    return regressions
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    scenarios = args.scenario or list(SCENARIOS)
+    transports = TRANSPORTS if args.transport == 'both' else (args.transport,)
+    if args.baseline:
+        baseline_path = os.path.abspath(args.baseline)
+    else:
+        baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), DEFAULT_BASELINE)
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    # server 在导入时会在当前目录初始化数据库和文件，因此先切换到临时目录
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix='justgetmynote-bench-')
+    os.chdir(workdir)
+    # atexit 按注册的逆序执行，临时目录在 server 写完日志之后才删除
+    atexit.register(shutil.rmtree, workdir, True)
+    # 所有请求都来自同一个地址，默认关闭按 IP 限流，否则测到的是 429 响应
+    if not args.rate_limits:
+        os.makedirs('settings')
+        with open(os.path.join('settings', 'main.txt'), 'w', encoding='utf-8') as f:
+            f.write('update_rate_limit = 0\ncreate_rate_limit = 0\n')
+    import server
+
+    print(f"生成合成数据：{args.notes} 篇笔记，每篇 {args.size} 字符（{workdir}）")
+    identifiers, share_ids = build_dataset(server, args, rng)
+
+    results = {}
+    print(f"{'transport/scenario':<28}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for transport in transports:
+        for name in scenarios:
+            burn_urls = create_burns(server, identifiers, args.requests, rng) if name == 'burn' else []
+            requests = build_requests(name, args.requests, identifiers, share_ids, burn_urls, rng)
+            runner = run_flask if transport == 'flask' else run_asgi
+            samples, elapsed = runner(server, requests, args.concurrency)
+            errors = sum(1 for _, status in samples if status >= 400)
+            key = f'{transport}/{name}'
+            results[key] = summarize([latency for latency, _ in samples], elapsed, errors)
+            row = results[key]
+            print(f"{key:<28}{row['rps']:>10}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['errors']:>8}")
+
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"结果已写入 {output_path}")
+
+    failed = [key for key, row in results.items() if row['errors']]
+    for key in failed:
+        print(f"错误：{key} 有 {results[key]['errors']} 个请求失败")
+
+    if args.save_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"基准已保存到 {baseline_path}")
+    elif not args.baseline and not os.path.exists(baseline_path):
+        print(f"没有找到基准文件 {baseline_path}，跳过比较（使用 --save-baseline 保存一次基准）")
+    else:
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for key, metric, current, previous in regressions:
+            print(f"性能退化：{key} {metric} {previous} -> {current}")
+        if regressions:
+            failed.append('baseline')
+        else:
+            print(f"与基准相比没有超过 {args.tolerance:.0%} 的退化")
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
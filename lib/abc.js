@@ -3,33 +3,218 @@
     document.addEventListener('DOMContentLoaded', function() {
         const contentArea = document.getElementById('content');
         let lastContent = contentArea.value;
+        // 服务器上已保存版本的哈希，作为增量补丁的基准
+        let lastHash = (typeof contentHash !== 'undefined' && contentHash) ? contentHash : null;
 
-        // 自动保存内容每秒检测一次
-        setInterval(function() {
+        function isHighSurrogate(code) {
+            return code >= 0xD800 && code <= 0xDBFF;
+        }
+
+        function isLowSurrogate(code) {
+            return code >= 0xDC00 && code <= 0xDFFF;
+        }
+
+        // 计算从 oldText 到 newText 的单段替换 [start, end, text]，不拆分代理对
+        function computePatch(oldText, newText) {
+            const minLength = Math.min(oldText.length, newText.length);
+            let start = 0;
+            while (start < minLength && oldText.charCodeAt(start) === newText.charCodeAt(start)) {
+                start++;
+            }
+            if (start > 0 && isHighSurrogate(oldText.charCodeAt(start - 1))) {
+                start--;
+            }
+            let oldEnd = oldText.length;
+            let newEnd = newText.length;
+            while (oldEnd > start && newEnd > start && oldText.charCodeAt(oldEnd - 1) === newText.charCodeAt(newEnd - 1)) {
+                oldEnd--;
+                newEnd--;
+            }
+            if (oldEnd < oldText.length && isLowSurrogate(oldText.charCodeAt(oldEnd))) {
+                oldEnd++;
+                newEnd++;
+            }
+            return [start, oldEnd, newText.slice(start, newEnd)];
+        }
+
+        // 有基准版本时发送增量补丁，补丁不比完整内容小时发送完整内容
+        function buildUpdateBody(currentContent, allowPatch) {
+            if (allowPatch && lastHash !== null) {
+                const patch = computePatch(lastContent, currentContent);
+                if (patch[2].length < currentContent.length) {
+                    return { 'base': lastHash, 'patch': patch };
+                }
+            }
+            return { 'content': currentContent };
+        }
+
+        // 自动保存：停止输入 SAVE_DEBOUNCE_MS 毫秒后保存，持续输入时最多 SAVE_MAX_WAIT_MS 毫秒保存一次
+        const SAVE_DEBOUNCE_MS = 800;
+        const SAVE_MAX_WAIT_MS = 3000;
+        // 429、503 和网络错误后按指数退避重试，服务器给出 Retry-After 时至少等待这么久
+        const BACKOFF_INITIAL_MS = 1000;
+        const BACKOFF_MAX_MS = 30000;
+        // 浏览器对 keepalive 请求体的大小限制为 64KB
+        const KEEPALIVE_MAX_BYTES = 60000;
+        let saveTimer = null;
+        let firstPendingAt = 0;  // 第一次未保存输入的时间，0 表示没有等待保存的输入
+        let inFlight = false;    // 同一笔记同时最多只有一个保存请求
+        let backoffMs = 0;
+        let retryAt = 0;
+        let rejectedContent = null;  // 被服务器拒绝的内容，再次输入前不重试
+        let maintenanceNotified = false;
+
+        function scheduleSave() {
+            const now = Date.now();
+            if (!firstPendingAt) {
+                firstPendingAt = now;
+            }
+            const delay = Math.max(Math.min(SAVE_DEBOUNCE_MS, firstPendingAt + SAVE_MAX_WAIT_MS - now), retryAt - now, 0);
+            clearTimeout(saveTimer);
+            saveTimer = setTimeout(flushSave, delay);
+        }
+
+        function flushSave(keepalive) {
+            clearTimeout(saveTimer);
+            saveTimer = null;
+            // 请求结束后会重新检查是否还有未保存的内容
+            if (inFlight) {
+                return;
+            }
             const currentContent = contentArea.value;
-            if (currentContent !== lastContent) {
-                fetch('/update/' + encodeURIComponent(identifier), {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({ 'content': currentContent })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.status === 'success') {
-                        console.log('Update successful');
-                        lastContent = currentContent;
-                        showSaveSuccess();
-                    } else {
+            if (currentContent === lastContent || currentContent === rejectedContent) {
+                firstPendingAt = 0;
+                return;
+            }
+            if (!keepalive && Date.now() < retryAt) {
+                scheduleSave();
+                return;
+            }
+            firstPendingAt = 0;
+            sendUpdate(currentContent, true, keepalive === true);
+        }
+
+        function backOff(retryAfter) {
+            backoffMs = Math.min(Math.max(backoffMs * 2, BACKOFF_INITIAL_MS), BACKOFF_MAX_MS);
+            // 只对指数退避部分加入随机抖动，避免多个标签页同时重试；最终等待时间不短于 Retry-After
+            let delay = backoffMs * (0.8 + Math.random() * 0.4);
+            const seconds = parseInt(retryAfter, 10);
+            if (!isNaN(seconds)) {
+                delay = Math.max(delay, seconds * 1000);
+            }
+            retryAt = Date.now() + delay;
+        }
+
+        function postUpdate(body, keepalive) {
+            const json = JSON.stringify(body);
+            return fetch('/update/' + encodeURIComponent(identifier), {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: json,
+                keepalive: keepalive && json.length * 3 <= KEEPALIVE_MAX_BYTES
+            });
+        }
+
+        function sendUpdate(currentContent, allowPatch, keepalive) {
+            inFlight = true;
+            postUpdate(buildUpdateBody(currentContent, allowPatch), keepalive)
+            .then(response => response.json().catch(() => ({})).then(data => {
+                if (response.status === 429 || response.status === 503) {
+                    if (response.status === 503 && data.message && !maintenanceNotified) {
+                        maintenanceNotified = true;
                         alert(data.message);
                     }
-                })
-                .catch((error) => {
-                    console.error('Error:', error);
-                });
+                    backOff(response.headers.get('Retry-After'));
+                    return;
+                }
+                if (data.status === 'success') {
+                    console.log('Update successful');
+                    lastContent = currentContent;
+                    lastHash = data.hash || null;
+                    backoffMs = 0;
+                    retryAt = 0;
+                    maintenanceNotified = false;
+                    showSaveSuccess();
+                } else if (data.code === 'base_mismatch' && allowPatch) {
+                    // 服务器上的版本与基准不一致，改为上传完整内容
+                    sendUpdate(currentContent, false, keepalive);
+                    return true;
+                } else {
+                    rejectedContent = currentContent;
+                    alert(data.message);
+                }
+            }))
+            .catch((error) => {
+                console.error('Error:', error);
+                backOff(null);
+            })
+            .then(resent => {
+                if (resent === true) {
+                    return;
+                }
+                inFlight = false;
+                if (contentArea.value !== lastContent) {
+                    scheduleSave();
+                }
+            });
+        }
+
+        contentArea.addEventListener('input', function() {
+            rejectedContent = null;
+            scheduleSave();
+        });
+
+        // 切到后台时立即保存，请求在页面随后被关闭时也会继续发送
+        document.addEventListener('visibilitychange', function() {
+            if (document.visibilityState === 'hidden') {
+                flushSave(true);
+            }
+        });
+
+        // 关闭页面时发送未保存的完整内容；此时已有请求在途也照常发送，页面关闭后无法再等待它结束
+        function flushOnUnload() {
+            const currentContent = contentArea.value;
+            if (currentContent !== lastContent && currentContent !== rejectedContent) {
+                postUpdate({ 'content': currentContent }, true).catch(() => {});
+                lastContent = currentContent;
+                // 无法确认是否保存成功，页面从缓存恢复后改为上传完整内容
+                lastHash = null;
             }
-        }, 1000); // 每秒检测一次
+        }
+        window.addEventListener('beforeunload', flushOnUnload);
+        window.addEventListener('pagehide', flushOnUnload);
+
+        // 订阅其他窗口或设备对同一笔记的修改
+        if (window.EventSource) {
+            const source = new EventSource('/events/' + encodeURIComponent(identifier) + '?hash=' + encodeURIComponent(lastHash || ''));
+            source.addEventListener('update', function(event) {
+                const data = JSON.parse(event.data);
+                // 本地有尚未保存的编辑时不覆盖，保存时会因基准不一致改为上传完整内容
+                if (contentArea.value !== lastContent) {
+                    return;
+                }
+                let newContent;
+                if (data.patch) {
+                    if (data.base !== lastHash) {
+                        return;
+                    }
+                    newContent = lastContent.slice(0, data.patch[0]) + data.patch[2] + lastContent.slice(data.patch[1]);
+                } else {
+                    newContent = data.content;
+                }
+                if (newContent !== contentArea.value) {
+                    const selectionStart = contentArea.selectionStart;
+                    const selectionEnd = contentArea.selectionEnd;
+                    contentArea.value = newContent;
+                    contentArea.setSelectionRange(Math.min(selectionStart, newContent.length), Math.min(selectionEnd, newContent.length));
+                }
+                lastContent = contentArea.value;
+                // 含有 \r 的内容在文本框中会被换行规范化，不能再作为补丁基准
+                lastHash = lastContent === newContent ? data.hash : null;
+            });
+        }
 
         // 处理 Share 按钮点击
         const shareButton = document.getElementById('shareButton');
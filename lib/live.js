@@ -0,0 +1,35 @@
+
+(function(){
+    document.addEventListener('DOMContentLoaded', function() {
+        const contentArea = document.getElementById('content');
+        if (!contentArea || !window.EventSource) {
+            return;
+        }
+        let lastHash = (typeof contentHash !== 'undefined') ? contentHash : '';
+        let source = null;
+
+        // /share/<share_id> 订阅 /events/share/<share_id>，/<id> 订阅 /events/<id>
+        function connect() {
+            source = new EventSource('/events' + window.location.pathname + '?hash=' + encodeURIComponent(lastHash));
+            source.addEventListener('update', function(event) {
+                const data = JSON.parse(event.data);
+                if (data.patch) {
+                    if (data.base !== lastHash) {
+                        // 错过了中间的版本，重新连接以获取完整内容
+                        source.close();
+                        lastHash = '';
+                        connect();
+                        return;
+                    }
+                    const value = contentArea.value;
+                    contentArea.value = value.slice(0, data.patch[0]) + data.patch[2] + value.slice(data.patch[1]);
+                } else {
+                    contentArea.value = data.content;
+                }
+                lastHash = data.hash;
+            });
+        }
+
+        connect();
+    });
+})();
@@ -1,15 +1,44 @@
-from flask import Flask, request, jsonify, send_from_directory, Response
+from flask import Flask, request, jsonify, send_from_directory, Response, make_response
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_etags
 import sqlite3
 import re
 import os
 import logging
+import logging.handlers
+import atexit
+import bisect
 from functools import wraps
 import secrets  # 用于生成安全的共享 ID
 import html     # 用于 HTML 转义
 import threading
 import time
 import queue  # 用于写入任务
-from asgiref.wsgi import WsgiToAsgi  # 导入 WSGI 转 ASGI 的适配器
+import json
+import asyncio  # 用于原生 ASGI 请求处理
+from concurrent.futures import ThreadPoolExecutor
+import hashlib  # 用于计算内容版本
+import gzip     # 用于压缩响应
+import zlib     # 用于压缩数据库中的内容
+import sys
+import io
+from collections import OrderedDict, deque
+import argparse
+import tarfile
+from urllib.parse import parse_qs
+from contextlib import contextmanager, redirect_stdout, ExitStack
+
+# brotli 为可选依赖，未安装时只提供 gzip 压缩
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# zstandard 为可选依赖，未安装时数据库中的内容使用 zlib 压缩
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 app = Flask(__name__)
 
@@ -19,7 +48,53 @@ MAIN_TEXT_FILE = 'main.txt'
 PORT = 6094
 META_FOLDER = 'meta'
 LOG_FILE = 'log.log'
+LOG_FORMAT = 'text'                # 日志格式：text 为 "IP - 路径 - 方法"，json 为带状态码和耗时的 JSON 行
+LOG_QUEUE_SIZE = 10000             # 日志队列的容量，写入跟不上时丢弃新的日志而不阻塞请求
+LOG_BATCH_SIZE = 1000              # 日志线程一次最多写入的条数
+LOG_FLUSH_INTERVAL = 0.5           # 日志线程最多攒多少秒的日志再写入文件
+LOG_MAX_BYTES = 10 * 1024 * 1024   # 日志文件超过该大小时轮转，0 表示不按大小轮转
+LOG_ROTATE_INTERVAL = 24 * 3600    # 日志文件每隔多少秒轮转一次，0 表示不按时间轮转
+LOG_BACKUP_COUNT = 7               # 轮转后保留的旧日志文件数（log.log.1 ... log.log.N）
 FAVICON_FILE = 'favicon.ico'
+CONTENT_CACHE_BYTES = 64 * 1024 * 1024  # contents 缓存的内存预算（字节）
+BURN_CACHE_BYTES = 16 * 1024 * 1024     # burn_contents 缓存的内存预算（字节）
+WRITE_BATCH_SIZE = 500       # 一个写入事务最多合并的笔记数，达到后立即提交
+WRITE_FLUSH_LATENCY = 0.05   # 第一条编辑入队后最多等待多少秒再提交，期间的编辑合并到同一事务
+WRITE_RETRY_DELAY = 1        # 数据库被锁、磁盘已满等暂时性错误时，重试写入前等待的秒数
+DB_POOL_SIZE = 16                   # 连接池中最多保留的空闲连接数
+DB_MMAP_SIZE = 256 * 1024 * 1024    # 每个连接的内存映射读取大小（字节）
+DB_CACHE_SIZE_KB = 16 * 1024        # 每个连接的页缓存大小（KB）
+COMPRESS_MIN_CHARS = 2048                  # 内容超过该字符数的页面才压缩
+COMPRESSED_CACHE_BYTES = 32 * 1024 * 1024  # 首页和共享页面压缩结果缓存的内存预算（字节）
+PUBLIC_PAGE_MAX_AGE = 10            # 首页和共享页面允许浏览器 / CDN 直接使用缓存的秒数，之后需重新验证
+ASGI_WORKER_THREADS = 16            # ASGI 模式下处理需要访问数据库的请求的线程数
+ASGI_MAX_BODY_BYTES = 2 * 1024 * 1024  # ASGI 模式下请求体的大小上限（字节）
+STORE_COMPRESS_MIN_CHARS = 4096  # 超过该字符数的内容在数据库中压缩保存
+CHANGE_LOG_RETENTION = 3600  # 变更日志保留的秒数，超出后由缓存刷新线程清理
+DATA_VERSION_POLL_INTERVAL = 0.05  # 检查数据库是否被其他连接或进程修改的间隔（秒），有修改时立即增量刷新缓存
+SHARED_DATABASE = True  # 阅后即焚链接总是在数据库中原子地领取；只在确定只有一个进程使用 content.db 时才能设为 False
+DB_SHARDS = 1  # 大于 1 时 contents、burn_contents 按键的哈希分散到多个数据库文件，每个分片有自己的写入线程；修改前先用 python server.py shard N 迁移
+SHARD_DATABASE_FORMAT = 'content-{}.db'  # 分片模式下各分片的数据库文件名
+REVISION_SNAPSHOT_INTERVAL = 20      # 每隔多少个历史版本保存一次完整快照，重建任意版本最多应用 19 个增量
+REVISION_COALESCE_SECONDS = 60       # 同一笔记在该秒数内的多次保存合并为一个历史版本
+REVISION_RETENTION = 30 * 24 * 3600  # 历史版本保留的秒数，0 表示永久保留
+REVISION_PRUNE_INTERVAL = 3600       # 清理过期历史版本的间隔（秒）
+SSE_HEARTBEAT_INTERVAL = 15  # 事件流空闲多少秒后发送一次心跳注释，避免被代理断开
+SSE_RETRY_MS = 3000          # 事件流断开后浏览器重新连接前等待的毫秒数
+PROFILE_DEFAULT_DURATION = 30  # settings 中没有 profile_duration 时的采样时长（秒）
+PROFILE_DEFAULT_RATE = 100     # settings 中没有 profile_rate 时每秒的采样次数
+UPDATE_RATE_LIMIT = 5          # 每个 IP 每秒可以发送的 /update 请求数（令牌补充速度），0 表示不限制
+UPDATE_RATE_BURST = 30         # 每个 IP 可以连续发送的 /update 请求数（令牌桶容量）
+CREATE_RATE_LIMIT = 0.5        # 每个 IP 每秒可以创建的共享和阅后即焚链接数，0 表示不限制
+CREATE_RATE_BURST = 10         # 每个 IP 可以连续创建的共享和阅后即焚链接数
+RATE_LIMIT_SWEEP_INTERVAL = 60  # 清理空闲令牌桶的间隔（秒）
+TRANSFER_BATCH_SIZE = 5000        # 导入导出时每批读取和写入的记录数
+TRANSFER_CHUNK_BYTES = 1024 * 1024  # 导出时每个并行压缩块的大小（字节）
+TRANSFER_COMPRESS_LEVEL = 6        # 导出文件的 gzip 压缩级别
+TRANSFER_CACHE_SIZE_KB = 512 * 1024  # 导入时连接的页缓存大小（KB），随机的哈希键写入大表时可减少读盘
+TAR_SHARE_ID_HEADER = 'JUSTGETMYNOTE.share_id'  # tar 导出中记录 share_id 的 pax 扩展头
+METRICS_LOCAL_ONLY = True    # /metrics 只允许本机访问（经反向代理访问时请在代理上限制）
+SETTINGS_POLL_INTERVAL = 0.1  # 检查 main.txt 和 settings/main.txt 是否变化的间隔（秒）
 SETTINGS_FOLDER = 'settings'
 MAIN_SETTINGS_FILE = os.path.join(SETTINGS_FOLDER, 'main.txt')
 
@@ -33,38 +108,508 @@ log = logging.getLogger('werkzeug')
 log.disabled = True
 app.logger.disabled = True
 
-# 设置自定义日志
+# 只把日志放入有界队列的处理器，队列已满时直接丢弃，不会阻塞请求线程
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# 后台日志线程：成批取出日志，一次写入文件，按大小或时间轮转
+class BatchingLogWriter:
+    def __init__(self, log_queue, path, log_format):
+        self.queue = log_queue
+        self.path = path
+        self.log_format = log_format
+        self.stream = None
+        self.rollover_at = 0
+        self.lock = threading.Lock()  # 退出时 drain 可能与日志线程同时写入
+
+    def _open(self):
+        self.stream = open(self.path, 'a', encoding='utf-8')
+        if LOG_ROTATE_INTERVAL:
+            self.rollover_at = time.time() + LOG_ROTATE_INTERVAL
+
+    def _rotate(self):
+        self.stream.close()
+        for i in range(LOG_BACKUP_COUNT - 1, 0, -1):
+            source = f'{self.path}.{i}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{i + 1}')
+        if LOG_BACKUP_COUNT > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    # 日志文件被其他进程或外部工具（如 logrotate）移走、替换时重新打开，与 WatchedFileHandler 相同
+    def _reopen_if_replaced(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        opened = os.fstat(self.stream.fileno())
+        if st is None or (st.st_dev, st.st_ino) != (opened.st_dev, opened.st_ino):
+            self.stream.close()
+            self._open()
+
+    def format(self, record):
+        if self.log_format != 'json':
+            return record.getMessage()
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname.lower(),
+        }
+        access = getattr(record, 'access', None)
+        if access is not None:
+            entry.update(access)
+        else:
+            entry['message'] = record.getMessage()
+        return json.dumps(entry, ensure_ascii=False)
+
+    def write(self, records):
+        data = ''.join(self.format(record) + '\n' for record in records)
+        with self.lock:
+            if self.stream is None:
+                self._open()
+            else:
+                self._reopen_if_replaced()
+            if LOG_ROTATE_INTERVAL and time.time() >= self.rollover_at:
+                self._rotate()
+            elif LOG_MAX_BYTES and self.stream.tell() > 0 and self.stream.tell() + len(data) > LOG_MAX_BYTES:
+                self._rotate()
+            self.stream.write(data)
+            self.stream.flush()
+
+    # 阻塞等待第一条日志，再在 LOG_FLUSH_INTERVAL 内尽量多取，合并为一次写入
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            while len(records) < LOG_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    records.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.write(records)
+            except Exception as e:
+                print(f"写入日志时出错: {e}", file=sys.stderr)
+
+    # 进程退出前写入队列中剩余的日志
+    def drain(self):
+        records = []
+        while True:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if records:
+            self.write(records)
+
+# 设置自定义日志：请求线程只把日志放入队列，由日志线程写入文件
 logger = logging.getLogger('custom_logger')
 logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler(LOG_FILE)
-formatter = logging.Formatter('%(message)s')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_handler = DroppingQueueHandler(log_queue)
+logger.addHandler(log_handler)
+log_writer = BatchingLogWriter(log_queue, LOG_FILE, LOG_FORMAT)
+
+# 按字节预算淘汰最久未使用条目的缓存（本身不加锁，调用方需持有 cache_lock）
+class LRUCache:
+    ENTRY_OVERHEAD = 100  # 每个条目在 OrderedDict 中的大致额外开销
+
+    def __init__(self, byte_budget):
+        self.byte_budget = byte_budget
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+
+    def _sizeof(self, key, value):
+        if isinstance(value, tuple):
+            value_size = sum(sys.getsizeof(item) for item in value)
+        else:
+            value_size = sys.getsizeof(value)
+        return sys.getsizeof(key) + value_size + self.ENTRY_OVERHEAD
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        size = self._sizeof(key, value)
+        if size > self.byte_budget:
+            return
+        self._entries[key] = (value, size)
+        self.total_bytes += size
+        while self.total_bytes > self.byte_budget:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self.total_bytes -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+
+    # 调整内存预算，缩小时立即淘汰最久未使用的条目
+    def resize(self, byte_budget):
+        self.byte_budget = byte_budget
+        while self.total_bytes > self.byte_budget:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+
+# 进程内的 Prometheus 指标：计数器和直方图按 (名称, 标签) 累加，抓取时输出文本格式
+class Metrics:
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}        # 名称 -> (类型, 说明, 分桶上限)
+        self._counters = {}    # (名称, 标签) -> 值
+        self._histograms = {}  # (名称, 标签) -> [各分桶计数..., +Inf 计数, 总和]
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self._meta[name] = ('histogram', help_text, buckets)
+
+    # labels 为 ((标签名, 值), ...)，调用方尽量复用同一个元组
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        buckets = self._meta[name][2]
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+            histogram[bisect.bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    # 输出 Prometheus 文本格式，gauges 为抓取时才计算的 [(名称, 说明, [(标签, 值), ...])]
+    def render(self, gauges):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in counters.items():
+                    if metric == name:
+                        lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            for (metric, labels), histogram in histograms.items():
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram[-1]}')
+                lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        for name, help_text, samples in gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+# 把标签元组格式化为 {name="value",...}
+def format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+metrics = Metrics()
+metrics.counter('justgetmynote_requests_total', 'Requests handled, by route, method and status.')
+metrics.histogram('justgetmynote_request_duration_seconds', 'Time to produce a response, by route.', Metrics.LATENCY_BUCKETS)
+metrics.counter('justgetmynote_cache_requests_total', 'Cache lookups, by cache and result.')
+metrics.histogram('justgetmynote_flush_batch_size', 'Notes committed per write transaction.', Metrics.SIZE_BUCKETS)
+metrics.histogram('justgetmynote_flush_duration_seconds', 'Duration of write-queue transactions.', Metrics.LATENCY_BUCKETS)
+metrics.histogram('justgetmynote_refresh_duration_seconds', 'Duration of incremental cache refreshes.', Metrics.LATENCY_BUCKETS)
+metrics.counter('justgetmynote_shares_created_total', 'Share links created.')
+metrics.counter('justgetmynote_burns_created_total', 'Burn-after-read links created.')
+metrics.counter('justgetmynote_burns_claimed_total', 'Burn-after-read links viewed.')
+metrics.counter('justgetmynote_rate_limited_total', 'Requests rejected by the per-IP rate limiter, by route.')
+
+CONTENTS_HIT = (('cache', 'contents'), ('result', 'hit'))
+CONTENTS_MISS = (('cache', 'contents'), ('result', 'miss'))
+SHARE_INDEX_HIT = (('cache', 'share_index'), ('result', 'hit'))
+SHARE_INDEX_MISS = (('cache', 'share_index'), ('result', 'miss'))
+BURN_HIT = (('cache', 'burn_contents'), ('result', 'hit'))
+BURN_MISS = (('cache', 'burn_contents'), ('result', 'miss'))
+COMPRESSED_HIT = (('cache', 'compressed_pages'), ('result', 'hit'))
+COMPRESSED_MISS = (('cache', 'compressed_pages'), ('result', 'miss'))
+
+# 按 IP 的令牌桶限流：每个桶只保存 (剩余令牌, 上次更新时间)，已经回满的桶与不存在的桶等价，定期清理
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.buckets = {}  # key -> (剩余令牌, 上次更新时间)
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+    def configure(self, rate, burst):
+        with self.lock:
+            self.rate = rate
+            self.burst = max(burst, 1)
+
+    # 取一个令牌，允许时返回 0，否则返回需要等待的秒数
+    def acquire(self, key):
+        now = time.monotonic()
+        with self.lock:
+            # 速度和容量在锁内读取，重新加载设置时不会在检查之后被改为 0
+            rate, burst = self.rate, self.burst
+            if rate <= 0:
+                return 0
+            if now - self.last_sweep >= RATE_LIMIT_SWEEP_INTERVAL:
+                self.sweep(now)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                tokens = burst
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    # 清理已经补满的令牌桶（调用方需持有 self.lock，且 rate 大于 0）
+    def sweep(self, now):
+        refill_time = self.burst / self.rate
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < refill_time}
+        self.last_sweep = now
+
+update_limiter = RateLimiter(UPDATE_RATE_LIMIT, UPDATE_RATE_BURST)
+create_limiter = RateLimiter(CREATE_RATE_LIMIT, CREATE_RATE_BURST)
+
+# 受限流的路由（POST）-> 限流器，创建共享和阅后即焚链接共用一个限流器
+RATE_LIMITERS = {'update': update_limiter, 'create_share': create_limiter, 'create_burn': create_limiter}
+
+# 采样分析器：按固定频率抓取所有线程（请求线程和后台线程）的调用栈，
+# 结束后以折叠栈格式写入文件，可直接用 flamegraph.pl 或 speedscope 查看
+class StackSampler:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.enabled = False  # 上一次读取设置时 profile 是否为 true
+        self.thread = None
+
+    # profile 从 false 变为 true 时开始一次采样，采样期间的重复开启被忽略
+    def apply_settings(self, settings):
+        enabled = settings.get('profile', False)
+        if enabled and not self.enabled and (self.thread is None or not self.thread.is_alive()):
+            duration = settings.get('profile_duration', PROFILE_DEFAULT_DURATION)
+            rate = settings.get('profile_rate', PROFILE_DEFAULT_RATE)
+            self.thread = threading.Thread(target=self.run, args=(duration, rate), name='profiler', daemon=True)
+            self.thread.start()
+        self.enabled = enabled
+
+    def run(self, duration, rate):
+        interval = 1.0 / max(rate, 1)
+        own_ident = threading.get_ident()
+        counts = {}
+        samples = 0
+        next_sample = time.monotonic()
+        deadline = next_sample + duration
+        while next_sample < deadline:
+            names = {thread.ident: thread.name.replace(';', '_') for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            next_sample += interval
+            time.sleep(max(0, next_sample - time.monotonic()))
+        path = os.path.join(self.output_dir, time.strftime('profile-%Y%m%d-%H%M%S.folded'))
+        with open(path, 'w', encoding='utf-8') as f:
+            for key, count in sorted(counts.items()):
+                f.write(f'{key} {count}\n')
+        logger.info(f"Profile written to {path} ({samples} samples).")
+
+profiler = StackSampler(os.path.dirname(os.path.abspath(LOG_FILE)))
 
 # 缓存结构
 cache = {
     'main_text': '',
+    'main_hash': '',       # main_text 的内容哈希，用作首页的 ETag
     'settings': {},
-    'contents': {},        # id -> 内容
-    'share_contents': {},  # share_id -> 内容
-    'burn_contents': {}    # burn_id -> 内容
+    'contents': LRUCache(CONTENT_CACHE_BYTES),      # id -> (内容, 内容哈希)
+    'share_ids': {},       # id -> share_id（所有已共享的笔记，共享页面通过它解析到笔记本身）
+    'share_index': {},     # share_id -> id
+    'burn_contents': LRUCache(BURN_CACHE_BYTES),    # burn_id -> 内容
+    'change_seqs': {},     # 分片序号 -> 缓存已同步到的该分片 change_log 序号
+    'generation': 0        # 每次缓存被写入或失效时递增，用于丢弃过期的懒加载结果
 }
 cache_lock = threading.Lock()
 
-# 写入队列
-write_queue = queue.Queue()
+# 压缩后的首页和共享页面，(页面类型, 路径, ETag, 编码) -> 压缩后的字节，受 cache_lock 保护
+compressed_pages = LRUCache(COMPRESSED_CACHE_BYTES)
+
+# 启动时预先压缩好的 lib 静态文件，文件名 -> {编码: 字节}
+static_assets = {}
+
+# 已加入写入队列但尚未提交到数据库的内容（id -> 内容），受 cache_lock 保护
+pending_writes = {}
+
+# 已被领取但尚未从数据库删除的 burn_id（墓碑），受 cache_lock 保护，期间不会再从数据库领取
+burned_ids = set()
+
+# 事件流的一个订阅者：只保存最新一条待发送的版本，发送跟不上时中间的版本直接合并掉
+class Subscriber:
+    def __init__(self, identifier, last_hash, notify):
+        self.identifier = identifier
+        self.last_hash = last_hash   # 客户端已经拥有的版本
+        self.has_cr = False          # 客户端的内容是否含有 \r（文本框会规范化换行，补丁偏移不再可靠）
+        self.pending = None          # (内容哈希, 内容, 补丁基准, 补丁)
+        self.notify = notify         # 有新版本时调用，可以在任意线程中调用
+
+# 笔记修改的扇出中心：每次修改只登记到各订阅者的待发送位置，由各自的连接取走并编码
+class EventHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # id -> {Subscriber}
+
+    def subscribe(self, identifier, last_hash, notify):
+        subscriber = Subscriber(identifier, last_hash, notify)
+        with self._lock:
+            self._subscribers.setdefault(identifier, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.identifier)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.identifier]
+
+    def has_subscribers(self, identifier):
+        return identifier in self._subscribers
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    # 发布一个新版本，补丁是相对 base 版本的 [start, end, text]
+    def publish(self, identifier, digest, content, base=None, patch=None):
+        if identifier not in self._subscribers:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers.get(identifier, ()))
+            for subscriber in subscribers:
+                subscriber.pending = (digest, content, base, patch)
+        for subscriber in subscribers:
+            subscriber.notify()
+
+    # 在订阅者还没有待发送版本时登记一个完整版本，不会覆盖已经发布的更新的版本
+    def offer(self, subscriber, digest, content):
+        with self._lock:
+            if subscriber.pending is None:
+                subscriber.pending = (digest, content, None, None)
+        subscriber.notify()
+
+    # 取走待发送的版本并编码为 SSE 消息，没有需要发送的内容时返回 None
+    def take(self, subscriber):
+        with self._lock:
+            pending = subscriber.pending
+            subscriber.pending = None
+        if pending is None:
+            return None
+        digest, content, base, patch = pending
+        if digest == subscriber.last_hash:
+            return None
+        has_cr = '\r' in content
+        # 客户端正好停在补丁的基准版本上时只发送补丁，否则发送完整内容
+        if patch is not None and base == subscriber.last_hash and not has_cr and not subscriber.has_cr:
+            data = {'hash': digest, 'base': base, 'patch': patch}
+        else:
+            data = {'hash': digest, 'content': content}
+        subscriber.last_hash = digest
+        subscriber.has_cr = has_cr
+        return f'id: {digest}\nevent: update\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+event_hub = EventHub()
 
-# 初始化数据库
-def init_db():
-    conn = sqlite3.connect(DATABASE)
+# 初始化数据库（分片模式下为第 index 个分片，共 count 个）
+def init_db(database=DATABASE, index=0, count=1):
+    conn = sqlite3.connect(database)
     conn.row_factory = sqlite3.Row  # 设置 row_factory 以便通过名称访问列
     c = conn.cursor()
 
+    # 使用 WAL 日志模式，写入时不阻塞读取（该设置保存在数据库文件中）
+    c.execute('PRAGMA journal_mode=WAL')
+
+    c.execute('BEGIN')
+
+    # 旧版本的数据库把内容直接保存在 contents、burn_contents 中，先改名，建好新表后再迁移
+    c.execute("SELECT name FROM pragma_table_info('contents') WHERE name = 'content'")
+    legacy = c.fetchone() is not None
+    if legacy:
+        c.execute('ALTER TABLE contents RENAME TO contents_old')
+        c.execute('ALTER TABLE burn_contents RENAME TO burn_contents_old')
+
+    # 创建 blobs 表：内容按哈希只保存一份，refcount 为引用它的笔记和阅后即焚链接数
+    # encoding 为内容的存储格式：plain 为原文，zlib、zstd 为压缩后的 UTF-8 字节
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            content BLOB NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            encoding TEXT NOT NULL DEFAULT 'plain'
+        )
+    ''')
+    c.execute("SELECT name FROM pragma_table_info('blobs') WHERE name = 'encoding'")
+    if c.fetchone() is None:
+        c.execute("ALTER TABLE blobs ADD COLUMN encoding TEXT NOT NULL DEFAULT 'plain'")
+
     # 创建 contents 表，如果不存在，添加 share_id 列
     c.execute('''
         CREATE TABLE IF NOT EXISTS contents (
             id TEXT PRIMARY KEY,
-            content TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
             share_id TEXT UNIQUE
         )
     ''')
@@ -73,27 +618,154 @@ def init_db():
     c.execute('''
         CREATE TABLE IF NOT EXISTS burn_contents (
             burn_id TEXT PRIMARY KEY,
-            content TEXT NOT NULL
+            content_hash TEXT NOT NULL
+        )
+    ''')
+
+    if legacy:
+        migrate_legacy_contents(conn)
+
+    # 创建 revisions 表，保存笔记的历史版本：chain 为 0 的是完整快照（data 的格式同 blobs），
+    # 其余为相对上一版本的单段替换 [start, end, text]（JSON），chain 为距上一个快照的增量数
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS revisions (
+            id TEXT NOT NULL,
+            rev INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            content_hash TEXT NOT NULL,
+            chain INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            encoding TEXT NOT NULL,
+            PRIMARY KEY (id, rev)
         )
     ''')
 
+    # 创建 change_log 表，记录 contents 和 burn_contents 的每一次变更，供缓存增量刷新
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl TEXT NOT NULL,
+            key TEXT NOT NULL,
+            changed_at INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+        )
+    ''')
+
+    # 通过触发器维护变更日志，任何写入路径（包括外部工具）都不会漏记
+    for table, key_column in (('contents', 'id'), ('burn_contents', 'burn_id')):
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_log
+                AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO change_log (tbl, key) VALUES ('{table}', {row}.{key_column});
+                END
+            ''')
+
+    # 通过触发器维护 blobs 的引用计数；计数归零的内容由缓存刷新线程定期清理，
+    # 同一事务中先解除引用、再被其他行引用的内容不会被提前删除
+    c.execute('CREATE INDEX IF NOT EXISTS blobs_unreferenced ON blobs (hash) WHERE refcount <= 0')
+    for table in ('contents', 'burn_contents'):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_insert_ref
+            AFTER INSERT ON {table}
+            BEGIN
+                UPDATE blobs SET refcount = refcount + 1 WHERE hash = NEW.content_hash;
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_update_ref
+            AFTER UPDATE OF content_hash ON {table}
+            WHEN OLD.content_hash IS NOT NEW.content_hash
+            BEGIN
+                UPDATE blobs SET refcount = refcount + 1 WHERE hash = NEW.content_hash;
+                UPDATE blobs SET refcount = refcount - 1 WHERE hash = OLD.content_hash;
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_delete_ref
+            AFTER DELETE ON {table}
+            BEGIN
+                UPDATE blobs SET refcount = refcount - 1 WHERE hash = OLD.content_hash;
+            END
+        ''')
+
     # 插入一些初始数据（可根据需要修改）
     initial_data = [
         ('dqjl', 'hi y'),
     ]
 
     for identifier, content in initial_data:
+        # 只插入到笔记所在的分片
+        if shard_index(identifier, count) != index:
+            continue
         # 检查是否已经存在该标识符
         c.execute('SELECT share_id FROM contents WHERE id = ?', (identifier,))
         row = c.fetchone()
         if not row:
             # 插入初始数据，没有 share_id
-            c.execute('INSERT INTO contents (id, content) VALUES (?, ?)', (identifier, content))
+            c.execute('INSERT INTO contents (id, content_hash) VALUES (?, ?)', (identifier, store_blob(c, content)))
 
     conn.commit()
     conn.close()
+
+# 初始化所有分片的数据库
+def init_databases():
+    for shard in shards:
+        init_db(shard.database, shard.index, len(shards))
+    # 数据还在另一种布局的文件中时，服务器会从空的数据库开始，提示先迁移
+    other = SHARD_DATABASE_FORMAT.format(0) if len(shards) == 1 else DATABASE
+    if os.path.exists(other):
+        print(f"警告：{other} 不属于当前的分片布局（DB_SHARDS = {DB_SHARDS}），其中的数据不会被读取，请用 python server.py shard {DB_SHARDS} 迁移。")
     print("数据库已初始化。")
 
+# 把旧表中的内容迁移到 blobs，笔记和阅后即焚链接改为引用内容哈希，迁移完成后删除旧表（连同旧表上的触发器）
+def migrate_legacy_contents(conn):
+    conn.create_function('content_hash', 1, content_hash, deterministic=True)
+    conn.execute('''
+        INSERT INTO blobs (hash, content, refcount)
+        SELECT content_hash(content), content, COUNT(*)
+        FROM (SELECT content FROM contents_old UNION ALL SELECT content FROM burn_contents_old)
+        GROUP BY content
+    ''')
+    conn.execute('INSERT INTO contents (id, content_hash, share_id) SELECT id, content_hash(content), share_id FROM contents_old')
+    conn.execute('INSERT INTO burn_contents (burn_id, content_hash) SELECT burn_id, content_hash(content) FROM burn_contents_old')
+    conn.execute('DROP TABLE contents_old')
+    conn.execute('DROP TABLE burn_contents_old')
+    print("数据库已迁移到按内容哈希存储。")
+
+# 把内容写入 blobs 表（相同的内容只保存一份），返回内容哈希
+# 引用计数由 contents、burn_contents 上的触发器维护，需在同一事务中插入引用它的行
+def store_blob(conn, content, digest=None):
+    if digest is None:
+        digest = content_hash(content)
+    conn.execute('INSERT INTO blobs (hash, content, encoding) VALUES (?, ?, ?) ON CONFLICT(hash) DO NOTHING', (digest, *encode_blob(content)))
+    return digest
+
+# 较大的内容压缩后保存，返回 (保存的值, 编码)；压缩后没有变小时保存原文
+def encode_blob(content):
+    if len(content) < STORE_COMPRESS_MIN_CHARS:
+        return content, 'plain'
+    raw = content.encode('utf-8', 'surrogatepass')
+    if zstandard:
+        data, encoding = zstandard.ZstdCompressor(level=3).compress(raw), 'zstd'
+    else:
+        data, encoding = zlib.compress(raw, 6), 'zlib'
+    if len(data) >= len(raw):
+        return content, 'plain'
+    return data, encoding
+
+# 还原 blobs 表中保存的内容
+def decode_blob(value, encoding):
+    if encoding == 'plain':
+        return value
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstandard is required to read zstd-compressed content')
+        raw = zstandard.ZstdDecompressor().decompress(value)
+    else:
+        raw = zlib.decompress(value)
+    return raw.decode('utf-8', 'surrogatepass')
+
 # 初始化 main.txt
 def init_main_txt():
     if not os.path.exists(MAIN_TEXT_FILE):
@@ -148,6 +820,27 @@ def init_settings():
     if not os.path.exists(MAIN_SETTINGS_FILE):
         default_content = """# Change this to enter read-only mode and the user will not be able to modify anything.
 construction = false
+
+# Change this to true to record a sampling profile of all threads for profile_duration seconds,
+# taking profile_rate samples per second. The result is written next to log.log as profile-*.folded.
+# Set it back to false and then to true again to record another one.
+profile = false
+profile_duration = 30
+profile_rate = 100
+
+# Runtime tuning. Uncomment and change a value to override the built-in default;
+# changes to this file are applied within about 100 ms without a restart.
+# write_flush_latency = 0.05
+# write_batch_size = 500
+# content_cache_bytes = 67108864
+# burn_cache_bytes = 16777216
+
+# Per-IP rate limits: requests per second, and how many requests may be sent in a burst.
+# The create limit is shared by share and burn-after-read links. Set a limit to 0 to disable it.
+update_rate_limit = 5
+update_rate_burst = 30
+create_rate_limit = 0.5
+create_rate_burst = 10
 """
         with open(MAIN_SETTINGS_FILE, 'w', encoding='utf-8') as f:
             f.write(default_content)
@@ -492,33 +1185,218 @@ template {
     document.addEventListener('DOMContentLoaded', function() {
         const contentArea = document.getElementById('content');
         let lastContent = contentArea.value;
+        // 服务器上已保存版本的哈希，作为增量补丁的基准
+        let lastHash = (typeof contentHash !== 'undefined' && contentHash) ? contentHash : null;
+
+        function isHighSurrogate(code) {
+            return code >= 0xD800 && code <= 0xDBFF;
+        }
+
+        function isLowSurrogate(code) {
+            return code >= 0xDC00 && code <= 0xDFFF;
+        }
+
+        // 计算从 oldText 到 newText 的单段替换 [start, end, text]，不拆分代理对
+        function computePatch(oldText, newText) {
+            const minLength = Math.min(oldText.length, newText.length);
+            let start = 0;
+            while (start < minLength && oldText.charCodeAt(start) === newText.charCodeAt(start)) {
+                start++;
+            }
+            if (start > 0 && isHighSurrogate(oldText.charCodeAt(start - 1))) {
+                start--;
+            }
+            let oldEnd = oldText.length;
+            let newEnd = newText.length;
+            while (oldEnd > start && newEnd > start && oldText.charCodeAt(oldEnd - 1) === newText.charCodeAt(newEnd - 1)) {
+                oldEnd--;
+                newEnd--;
+            }
+            if (oldEnd < oldText.length && isLowSurrogate(oldText.charCodeAt(oldEnd))) {
+                oldEnd++;
+                newEnd++;
+            }
+            return [start, oldEnd, newText.slice(start, newEnd)];
+        }
 
-        // 自动保存内容每秒检测一次
-        setInterval(function() {
+        // 有基准版本时发送增量补丁，补丁不比完整内容小时发送完整内容
+        function buildUpdateBody(currentContent, allowPatch) {
+            if (allowPatch && lastHash !== null) {
+                const patch = computePatch(lastContent, currentContent);
+                if (patch[2].length < currentContent.length) {
+                    return { 'base': lastHash, 'patch': patch };
+                }
+            }
+            return { 'content': currentContent };
+        }
+
+        // 自动保存：停止输入 SAVE_DEBOUNCE_MS 毫秒后保存，持续输入时最多 SAVE_MAX_WAIT_MS 毫秒保存一次
+        const SAVE_DEBOUNCE_MS = 800;
+        const SAVE_MAX_WAIT_MS = 3000;
+        // 429、503 和网络错误后按指数退避重试，服务器给出 Retry-After 时至少等待这么久
+        const BACKOFF_INITIAL_MS = 1000;
+        const BACKOFF_MAX_MS = 30000;
+        // 浏览器对 keepalive 请求体的大小限制为 64KB
+        const KEEPALIVE_MAX_BYTES = 60000;
+        let saveTimer = null;
+        let firstPendingAt = 0;  // 第一次未保存输入的时间，0 表示没有等待保存的输入
+        let inFlight = false;    // 同一笔记同时最多只有一个保存请求
+        let backoffMs = 0;
+        let retryAt = 0;
+        let rejectedContent = null;  // 被服务器拒绝的内容，再次输入前不重试
+        let maintenanceNotified = false;
+
+        function scheduleSave() {
+            const now = Date.now();
+            if (!firstPendingAt) {
+                firstPendingAt = now;
+            }
+            const delay = Math.max(Math.min(SAVE_DEBOUNCE_MS, firstPendingAt + SAVE_MAX_WAIT_MS - now), retryAt - now, 0);
+            clearTimeout(saveTimer);
+            saveTimer = setTimeout(flushSave, delay);
+        }
+
+        function flushSave(keepalive) {
+            clearTimeout(saveTimer);
+            saveTimer = null;
+            // 请求结束后会重新检查是否还有未保存的内容
+            if (inFlight) {
+                return;
+            }
             const currentContent = contentArea.value;
-            if (currentContent !== lastContent) {
-                fetch('/update/' + encodeURIComponent(identifier), {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({ 'content': currentContent })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.status === 'success') {
-                        console.log('Update successful');
-                        lastContent = currentContent;
-                        showSaveSuccess();
-                    } else {
+            if (currentContent === lastContent || currentContent === rejectedContent) {
+                firstPendingAt = 0;
+                return;
+            }
+            if (!keepalive && Date.now() < retryAt) {
+                scheduleSave();
+                return;
+            }
+            firstPendingAt = 0;
+            sendUpdate(currentContent, true, keepalive === true);
+        }
+
+        function backOff(retryAfter) {
+            backoffMs = Math.min(Math.max(backoffMs * 2, BACKOFF_INITIAL_MS), BACKOFF_MAX_MS);
+            // 只对指数退避部分加入随机抖动，避免多个标签页同时重试；最终等待时间不短于 Retry-After
+            let delay = backoffMs * (0.8 + Math.random() * 0.4);
+            const seconds = parseInt(retryAfter, 10);
+            if (!isNaN(seconds)) {
+                delay = Math.max(delay, seconds * 1000);
+            }
+            retryAt = Date.now() + delay;
+        }
+
+        function postUpdate(body, keepalive) {
+            const json = JSON.stringify(body);
+            return fetch('/update/' + encodeURIComponent(identifier), {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: json,
+                keepalive: keepalive && json.length * 3 <= KEEPALIVE_MAX_BYTES
+            });
+        }
+
+        function sendUpdate(currentContent, allowPatch, keepalive) {
+            inFlight = true;
+            postUpdate(buildUpdateBody(currentContent, allowPatch), keepalive)
+            .then(response => response.json().catch(() => ({})).then(data => {
+                if (response.status === 429 || response.status === 503) {
+                    if (response.status === 503 && data.message && !maintenanceNotified) {
+                        maintenanceNotified = true;
                         alert(data.message);
                     }
-                })
-                .catch((error) => {
-                    console.error('Error:', error);
-                });
+                    backOff(response.headers.get('Retry-After'));
+                    return;
+                }
+                if (data.status === 'success') {
+                    console.log('Update successful');
+                    lastContent = currentContent;
+                    lastHash = data.hash || null;
+                    backoffMs = 0;
+                    retryAt = 0;
+                    maintenanceNotified = false;
+                    showSaveSuccess();
+                } else if (data.code === 'base_mismatch' && allowPatch) {
+                    // 服务器上的版本与基准不一致，改为上传完整内容
+                    sendUpdate(currentContent, false, keepalive);
+                    return true;
+                } else {
+                    rejectedContent = currentContent;
+                    alert(data.message);
+                }
+            }))
+            .catch((error) => {
+                console.error('Error:', error);
+                backOff(null);
+            })
+            .then(resent => {
+                if (resent === true) {
+                    return;
+                }
+                inFlight = false;
+                if (contentArea.value !== lastContent) {
+                    scheduleSave();
+                }
+            });
+        }
+
+        contentArea.addEventListener('input', function() {
+            rejectedContent = null;
+            scheduleSave();
+        });
+
+        // 切到后台时立即保存，请求在页面随后被关闭时也会继续发送
+        document.addEventListener('visibilitychange', function() {
+            if (document.visibilityState === 'hidden') {
+                flushSave(true);
             }
-        }, 1000); // 每秒检测一次
+        });
+
+        // 关闭页面时发送未保存的完整内容；此时已有请求在途也照常发送，页面关闭后无法再等待它结束
+        function flushOnUnload() {
+            const currentContent = contentArea.value;
+            if (currentContent !== lastContent && currentContent !== rejectedContent) {
+                postUpdate({ 'content': currentContent }, true).catch(() => {});
+                lastContent = currentContent;
+                // 无法确认是否保存成功，页面从缓存恢复后改为上传完整内容
+                lastHash = null;
+            }
+        }
+        window.addEventListener('beforeunload', flushOnUnload);
+        window.addEventListener('pagehide', flushOnUnload);
+
+        // 订阅其他窗口或设备对同一笔记的修改
+        if (window.EventSource) {
+            const source = new EventSource('/events/' + encodeURIComponent(identifier) + '?hash=' + encodeURIComponent(lastHash || ''));
+            source.addEventListener('update', function(event) {
+                const data = JSON.parse(event.data);
+                // 本地有尚未保存的编辑时不覆盖，保存时会因基准不一致改为上传完整内容
+                if (contentArea.value !== lastContent) {
+                    return;
+                }
+                let newContent;
+                if (data.patch) {
+                    if (data.base !== lastHash) {
+                        return;
+                    }
+                    newContent = lastContent.slice(0, data.patch[0]) + data.patch[2] + lastContent.slice(data.patch[1]);
+                } else {
+                    newContent = data.content;
+                }
+                if (newContent !== contentArea.value) {
+                    const selectionStart = contentArea.selectionStart;
+                    const selectionEnd = contentArea.selectionEnd;
+                    contentArea.value = newContent;
+                    contentArea.setSelectionRange(Math.min(selectionStart, newContent.length), Math.min(selectionEnd, newContent.length));
+                }
+                lastContent = contentArea.value;
+                // 含有 \\r 的内容在文本框中会被换行规范化，不能再作为补丁基准
+                lastHash = lastContent === newContent ? data.hash : null;
+            });
+        }
 
         // 处理 Share 按钮点击
         const shareButton = document.getElementById('shareButton');
@@ -609,42 +1487,389 @@ template {
 """
     with open(os.path.join('lib', 'abc.js'), 'w', encoding='utf-8') as f:
         f.write(js_content)
+    # 写入只读页面的实时更新脚本到 lib/live.js
+    live_js_content = """
+(function(){
+    document.addEventListener('DOMContentLoaded', function() {
+        const contentArea = document.getElementById('content');
+        if (!contentArea || !window.EventSource) {
+            return;
+        }
+        let lastHash = (typeof contentHash !== 'undefined') ? contentHash : '';
+        let source = null;
+
+        // /share/<share_id> 订阅 /events/share/<share_id>，/<id> 订阅 /events/<id>
+        function connect() {
+            source = new EventSource('/events' + window.location.pathname + '?hash=' + encodeURIComponent(lastHash));
+            source.addEventListener('update', function(event) {
+                const data = JSON.parse(event.data);
+                if (data.patch) {
+                    if (data.base !== lastHash) {
+                        // 错过了中间的版本，重新连接以获取完整内容
+                        source.close();
+                        lastHash = '';
+                        connect();
+                        return;
+                    }
+                    const value = contentArea.value;
+                    contentArea.value = value.slice(0, data.patch[0]) + data.patch[2] + value.slice(data.patch[1]);
+                } else {
+                    contentArea.value = data.content;
+                }
+                lastHash = data.hash;
+            });
+        }
+
+        connect();
+    });
+})();
+"""
+    with open(os.path.join('lib', 'live.js'), 'w', encoding='utf-8') as f:
+        f.write(live_js_content)
+
+# 预先压缩 lib 下的 CSS 和 JavaScript，请求时按 Accept-Encoding 直接返回对应版本
+def init_static_assets():
+    for filename, mimetype in (('abc.css', 'text/css'), ('abc.js', 'application/javascript'), ('live.js', 'application/javascript')):
+        with open(os.path.join('lib', filename), 'rb') as f:
+            body = f.read()
+        variants = {
+            'mimetype': mimetype,
+            'etag': content_hash(body.decode('utf-8')),
+            'identity': body,
+            'gzip': compress_body(body, 'gzip', static=True),
+        }
+        if brotli:
+            variants['br'] = compress_body(body, 'br', static=True)
+        static_assets[filename] = variants
+
+# settings/main.txt 支持的键：键 -> (类型, 默认值)
+SETTING_TYPES = {
+    'construction': (bool, False),
+    'profile': (bool, False),
+    'profile_duration': (float, PROFILE_DEFAULT_DURATION),
+    'profile_rate': (float, PROFILE_DEFAULT_RATE),
+    'write_flush_latency': (float, WRITE_FLUSH_LATENCY),
+    'write_batch_size': (int, WRITE_BATCH_SIZE),
+    'content_cache_bytes': (int, CONTENT_CACHE_BYTES),
+    'burn_cache_bytes': (int, BURN_CACHE_BYTES),
+    'update_rate_limit': (float, UPDATE_RATE_LIMIT),
+    'update_rate_burst': (int, UPDATE_RATE_BURST),
+    'create_rate_limit': (float, CREATE_RATE_LIMIT),
+    'create_rate_burst': (int, CREATE_RATE_BURST),
+}
+
+# 按类型解析设置值，无法解析时抛出 ValueError
+def parse_setting(kind, value):
+    if kind is bool:
+        if value.lower() not in ('true', 'false'):
+            raise ValueError(value)
+        return value.lower() == 'true'
+    parsed = kind(value)
+    if parsed < 0:
+        raise ValueError(value)
+    return parsed
+
+# 读取 settings/main.txt，返回包含所有键的设置字典；文件中没有的键、未知的键和无法解析的值使用默认值
+def read_settings():
+    settings = {key: default for key, (kind, default) in SETTING_TYPES.items()}
+    if not os.path.exists(MAIN_SETTINGS_FILE):
+        return settings
+    with open(MAIN_SETTINGS_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#') or not line:
+                continue
+            if '=' in line:
+                key, value = line.split('=', 1)
+                key = key.strip().lower()
+                value = value.strip()
+                if key not in SETTING_TYPES:
+                    logger.warning(f"Unknown setting ignored: {key}")
+                    continue
+                try:
+                    settings[key] = parse_setting(SETTING_TYPES[key][0], value)
+                except ValueError:
+                    logger.warning(f"Invalid value for setting {key}: {value}")
+    return settings
+
+# 读取一个设置（从缓存获取）
+def get_setting(key):
+    with cache_lock:
+        return cache['settings'].get(key, SETTING_TYPES[key][1])
+
+# 应用新的设置：更新缓存中的设置和缓存预算，并按需开始性能采样
+def apply_settings(settings):
+    with cache_lock:
+        cache['settings'] = settings
+        cache['contents'].resize(settings['content_cache_bytes'])
+        cache['burn_contents'].resize(settings['burn_cache_bytes'])
+    update_limiter.configure(settings['update_rate_limit'], settings['update_rate_burst'])
+    create_limiter.configure(settings['create_rate_limit'], settings['create_rate_burst'])
+    profiler.apply_settings(settings)
+
+# 重新读取 main.txt
+def reload_main_text():
+    if os.path.exists(MAIN_TEXT_FILE):
+        with open(MAIN_TEXT_FILE, 'r', encoding='utf-8') as f:
+            set_main_text(f.read())
+    else:
+        set_main_text("")
+
+# 重新读取 settings/main.txt
+def reload_settings():
+    apply_settings(read_settings())
+
+# 文件的签名 (修改时间, 大小, inode)，文件不存在时为 None
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+# 文件监视：定期比较文件签名，只在文件变化（包括创建和删除）时调用对应的重新加载函数
+class FileWatcher:
+    def __init__(self, handlers):
+        self.handlers = handlers  # 路径 -> 重新加载函数
+        self.signatures = {}
+
+    def poll(self):
+        for path, handler in self.handlers.items():
+            signature = file_signature(path)
+            if path in self.signatures and self.signatures[path] == signature:
+                continue
+            handler()
+            # 重新加载成功后才记录签名，失败时下一轮重试
+            self.signatures[path] = signature
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"重新加载设置时出错: {e}")
+
+settings_watcher = FileWatcher({MAIN_TEXT_FILE: reload_main_text, MAIN_SETTINGS_FILE: reload_settings})
 
 # 读取 construction 模式（从缓存获取）
 def is_construction_mode():
-    with cache_lock:
-        return cache['settings'].get('construction', False)
+    return get_setting('construction')
+
+# SQLite 连接池：连接及其预编译语句缓存在请求之间复用，不再为每次查询重新打开数据库
+class ConnectionPool:
+    def __init__(self, database, max_idle):
+        self.database = database
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        except BaseException:
+            # 出错的连接状态未知，直接关闭而不放回池中
+            conn.close()
+            raise
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
-# 获取数据库连接
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+# 一个数据库分片：有自己的连接池、写入队列和阅后即焚删除队列，各分片的写入线程互不等待
+class Shard:
+    def __init__(self, index, database):
+        self.index = index
+        self.database = database
+        self.pool = ConnectionPool(database, DB_POOL_SIZE)
+        self.write_queue = queue.Queue()
+        self.burn_delete_queue = queue.Queue()  # 等待删除线程批量删除的 burn_id
+        # 写入线程提交事务与缓存刷新线程读取数据库时互斥，避免刷新读到的旧行覆盖刚提交的新内容
+        self.flush_lock = threading.Lock()
+
+# 各分片的数据库文件，只有一个分片时就是 content.db
+def shard_databases(count):
+    if count <= 1:
+        return [DATABASE]
+    return [SHARD_DATABASE_FORMAT.format(i) for i in range(count)]
+
+# 键（笔记 id 或 burn_id）所在的分片序号；使用 CRC32 而不是 hash()，结果与进程和 Python 版本无关
+def shard_index(key, count):
+    if count <= 1:
+        return 0
+    return zlib.crc32(key.encode('utf-8')) % count
+
+shards = [Shard(index, database) for index, database in enumerate(shard_databases(DB_SHARDS))]
+
+# 获取键所在的分片
+def shard_for(key):
+    return shards[shard_index(key, len(shards))]
+
+# 获取键所在分片的数据库连接（用法：with db_connection(identifier) as conn）
+def db_connection(key):
+    return shard_for(key).pool.connection()
+
+# 读取 change_log 当前的最大序号（包括已被清理的部分）
+def get_max_change_seq(c):
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+    row = c.fetchone()
+    return row['seq'] if row else 0
+
+# 清空内容缓存，之后的访问会按需从数据库重新加载
+def reset_content_cache():
+    with ExitStack() as stack:
+        change_seqs = {}
+        share_rows = []
+        for shard in shards:
+            # 按分片顺序加锁，与只锁一个分片的写入和刷新不会死锁
+            stack.enter_context(shard.flush_lock)
+            with shard.pool.connection() as conn:
+                change_seqs[shard.index] = get_max_change_seq(conn.cursor())
+                # 共享索引只包含 id 和 share_id，始终完整地保存在内存中
+                share_rows.extend(conn.execute('SELECT id, share_id FROM contents WHERE share_id IS NOT NULL').fetchall())
+        with cache_lock:
+            cache['contents'].clear()
+            cache['burn_contents'].clear()
+            cache['share_ids'] = {row['id']: row['share_id'] for row in share_rows}
+            cache['share_index'] = {row['share_id']: row['id'] for row in share_rows}
+            # 尚未写入数据库的编辑仍保存在 pending_writes 中，读取时会优先使用
+            cache['change_seqs'] = change_seqs
+            cache['generation'] += 1
+
+# 按 change_log 增量刷新缓存（默认刷新所有分片）
+def refresh_changed_contents(targets=None):
+    for shard in shards if targets is None else targets:
+        if refresh_shard_contents(shard):
+            # 整个缓存已被清空，其余分片不必再刷新
+            reset_content_cache()
+            return
+
+# 刷新一个分片，只读取上次刷新之后发生变化、且仍在缓存中的行；需要清空缓存时返回 True
+def refresh_shard_contents(shard):
+    with shard.flush_lock:
+        with cache_lock:
+            last_seq = cache['change_seqs'].get(shard.index, 0)
+        with shard.pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('BEGIN')
+            # 如果需要的日志已被清理，无法知道哪些条目过期，只能清空缓存
+            c.execute('SELECT MIN(seq) AS min_seq FROM change_log')
+            min_seq = c.fetchone()['min_seq']
+            max_seq = get_max_change_seq(c)
+            need_reset = max_seq > last_seq and (min_seq is None or min_seq > last_seq + 1)
+            if not need_reset:
+                c.execute('SELECT DISTINCT tbl, key FROM change_log WHERE seq > ? AND seq <= ?', (last_seq, max_seq))
+                changed = {'contents': [], 'burn_contents': []}
+                for row in c.fetchall():
+                    changed[row['tbl']].append(row['key'])
+                changed_ids = changed['contents']
+                # 共享索引需要覆盖所有变化的笔记，内容则只重新读取已缓存或有人订阅的条目，其余的在下次访问时懒加载
+                share_rows = fetch_rows_by_keys(c, 'SELECT id, share_id FROM contents WHERE id IN ({})', changed['contents'])
+                with cache_lock:
+                    changed['contents'] = [k for k in changed['contents'] if k in cache['contents'] or event_hub.has_subscribers(k)]
+                    changed['burn_contents'] = [k for k in changed['burn_contents'] if k in cache['burn_contents']]
+                content_rows = fetch_rows_by_keys(c, '''
+                    SELECT contents.id, contents.content_hash, blobs.content, blobs.encoding FROM contents
+                    JOIN blobs ON blobs.hash = contents.content_hash
+                    WHERE contents.id IN ({})
+                ''', changed['contents'])
+                burn_rows = fetch_rows_by_keys(c, '''
+                    SELECT burn_contents.burn_id, blobs.content, blobs.encoding FROM burn_contents
+                    JOIN blobs ON blobs.hash = burn_contents.content_hash
+                    WHERE burn_contents.burn_id IN ({})
+                ''', changed['burn_contents'])
+            conn.rollback()
+
+        if not need_reset:
+            # 在加锁之前解压
+            content_rows = [(row['id'], row['content_hash'], decode_blob(row['content'], row['encoding'])) for row in content_rows]
+            burn_rows = [(row['burn_id'], decode_blob(row['content'], row['encoding'])) for row in burn_rows]
+            found_ids = set()
+            with cache_lock:
+                for row in share_rows:
+                    found_ids.add(row['id'])
+                    set_share_id(row['id'], row['share_id'])
+                for identifier in changed_ids:
+                    if identifier not in found_ids:
+                        set_share_id(identifier, None)
+                for identifier, digest, content in content_rows:
+                    # 写入队列中还有更新的编辑，保留内存中的版本
+                    if identifier in pending_writes:
+                        continue
+                    cache['contents'][identifier] = (content, digest)
+                    # 其他进程写入的修改同样推送给订阅者
+                    event_hub.publish(identifier, digest, content)
+                for identifier in changed['contents']:
+                    if identifier not in found_ids and identifier not in pending_writes:
+                        cache['contents'].pop(identifier, None)
+                        event_hub.publish(identifier, EMPTY_CONTENT_HASH, '')
+                found_burn_ids = set()
+                for burn_id, content in burn_rows:
+                    found_burn_ids.add(burn_id)
+                    # 已被领取的内容不能重新放回缓存
+                    if burn_id in burned_ids:
+                        continue
+                    cache['burn_contents'][burn_id] = content
+                for burn_id in changed['burn_contents']:
+                    if burn_id not in found_burn_ids:
+                        cache['burn_contents'].pop(burn_id, None)
+                cache['change_seqs'][shard.index] = max_seq
+                cache['generation'] += 1
+    return need_reset
+
+# 清理过期的变更日志和不再被引用的内容（只在定期刷新时进行，避免每次刷新都提交一次写事务）
+def cleanup_database():
+    for shard in shards:
+        with shard.flush_lock:
+            with shard.pool.connection() as conn:
+                conn.execute("DELETE FROM change_log WHERE changed_at < strftime('%s', 'now') - ?", (CHANGE_LOG_RETENTION,))
+                conn.execute('DELETE FROM blobs WHERE refcount <= 0')
+                conn.commit()
 
-# 获取所有内容并更新缓存
-def load_all_contents_to_cache():
-    conn = get_db_connection()
-    c = conn.cursor()
-    # 加载 contents
-    c.execute('SELECT id, content, share_id FROM contents')
-    rows = c.fetchall()
-    # 加载 burn_contents
-    c.execute('SELECT burn_id, content FROM burn_contents')
-    burn_rows = c.fetchall()
-    conn.close()
-    contents = {}
-    share_contents = {}
-    for row in rows:
-        contents[row['id']] = row['content']
-        if row['share_id']:
-            share_contents[row['share_id']] = row['content']
-    burn_contents = {}
-    for row in burn_rows:
-        burn_contents[row['burn_id']] = row['content']
-    with cache_lock:
-        cache['contents'] = contents
-        cache['share_contents'] = share_contents  # 更新 share_contents 缓存
-        cache['burn_contents'] = burn_contents    # 更新 burn_contents 缓存
+# 记录一次缓存刷新的耗时
+def timed_refresh(targets=None):
+    start = time.perf_counter()
+    refresh_changed_contents(targets)
+    metrics.observe('justgetmynote_refresh_duration_seconds', time.perf_counter() - start)
+
+# 跨进程缓存一致性：PRAGMA data_version 在其他连接（包括其他进程）提交修改后会变化，
+# 变化时立即按 change_log 增量刷新，只失效或重新读取发生变化的条目；每个分片一个监视线程
+def watch_data_version(shard):
+    conn = sqlite3.connect(shard.database)
+    last_version = None
+    while True:
+        try:
+            version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if version != last_version:
+                last_version = version
+                timed_refresh([shard])
+        except Exception as e:
+            logger.error(f"Error checking database changes: {e}")
+        time.sleep(DATA_VERSION_POLL_INTERVAL)
+
+# 分批执行 IN 查询，避免超过 SQLite 的参数个数限制
+def fetch_rows_by_keys(c, sql, keys, batch_size=500):
+    rows = []
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        c.execute(sql.format(', '.join('?' * len(batch))), batch)
+        rows.extend(c.fetchall())
+    return rows
 
 # 生成唯一的16字符十六进制共享ID
 def generate_share_id():
@@ -660,263 +1885,620 @@ def generate_burn_id():
         if not burn_id_exists(burn_id):
             return burn_id
 
-# 检查 share_id 是否存在
+# 检查 share_id 是否存在（share_id 跟随笔记保存在笔记所在的分片，需要检查所有分片）
 def share_id_exists(share_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT id FROM contents WHERE share_id = ?', (share_id,))
-    row = c.fetchone()
-    conn.close()
-    return row is not None
+    return find_share_id(share_id) is not None
+
+# 在所有分片中查找 share_id 对应的笔记 id，不存在时返回 None
+def find_share_id(share_id):
+    for shard in shards:
+        with shard.pool.connection() as conn:
+            row = conn.execute('SELECT id FROM contents WHERE share_id = ?', (share_id,)).fetchone()
+        if row is not None:
+            return row['id']
+    return None
 
 # 检查 burn_id 是否存在
 def burn_id_exists(burn_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT burn_id FROM burn_contents WHERE burn_id = ?', (burn_id,))
-    row = c.fetchone()
-    conn.close()
+    with db_connection(burn_id) as conn:
+        row = conn.execute('SELECT burn_id FROM burn_contents WHERE burn_id = ?', (burn_id,)).fetchone()
     return row is not None
 
-# 获取内容通过 share_id（从缓存读取）
-def get_content_by_share_id(share_id):
+# 计算内容的版本哈希，用于增量保存时校验客户端的基准版本
+def content_hash(content):
+    return hashlib.blake2b(content.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+
+# 只允许读取缓存时，缓存未命中的返回值
+CACHE_MISS = object()
+
+# 获取笔记的 (内容, 内容哈希)（优先读取缓存和未写入的编辑，未命中时查询数据库）
+# cache_only 为 True 时不访问数据库，未命中时返回 CACHE_MISS
+def get_note(identifier, cache_only=False):
     with cache_lock:
-        return cache['share_contents'].get(share_id, None)
+        entry = cache['contents'].get(identifier)
+        if entry is None and identifier in pending_writes:
+            content = pending_writes[identifier]
+            entry = (content, content_hash(content))
+            cache['contents'][identifier] = entry
+        generation = cache['generation']
+    if entry is not None:
+        metrics.inc('justgetmynote_cache_requests_total', CONTENTS_HIT)
+        return entry
+    if cache_only:
+        return CACHE_MISS
+    metrics.inc('justgetmynote_cache_requests_total', CONTENTS_MISS)
+    with db_connection(identifier) as conn:
+        row = conn.execute('''
+            SELECT blobs.content, blobs.encoding, contents.content_hash FROM contents
+            JOIN blobs ON blobs.hash = contents.content_hash
+            WHERE contents.id = ?
+        ''', (identifier,)).fetchone()
+    if row is None:
+        return None
+    entry = (decode_blob(row['content'], row['encoding']), row['content_hash'])
+    with cache_lock:
+        # 查询期间缓存有过变动，数据库中读到的可能已经过期，不再写入缓存
+        if cache['generation'] == generation:
+            cache['contents'][identifier] = entry
+    return entry
+
+EMPTY_CONTENT_HASH = content_hash('')
 
-# 获取内容通过 burn_id（从缓存读取）
-def get_content_by_burn_id(burn_id):
+# 更新缓存中的 main.txt 内容及其哈希
+def set_main_text(main_text):
+    main_hash = content_hash(main_text)
+    with cache_lock:
+        cache['main_text'] = main_text
+        cache['main_hash'] = main_hash
+
+# 获取内容通过 id
+def get_content_by_id(identifier):
+    entry = get_note(identifier)
+    return entry[0] if entry else None
+
+# 将增量补丁 [start, end, text] 应用到内容上，偏移量以 UTF-16 码元计（与浏览器中的字符串下标一致）
+def apply_patch(content, patch):
+    if not isinstance(patch, list) or len(patch) != 3:
+        raise ValueError('Malformed patch.')
+    start, end, text = patch
+    if type(start) is not int or type(end) is not int or not isinstance(text, str):
+        raise ValueError('Malformed patch.')
+    if content.isascii():
+        # 纯 ASCII 内容的码元下标与字符下标相同，直接切片
+        if not 0 <= start <= end <= len(content):
+            raise ValueError('Patch out of range.')
+        return content[:start] + text + content[end:]
+    units = content.encode('utf-16-le', 'surrogatepass')
+    if not 0 <= start <= end <= len(units) // 2:
+        raise ValueError('Patch out of range.')
+    patched = units[:start * 2] + text.encode('utf-16-le', 'surrogatepass') + units[end * 2:]
+    return patched.decode('utf-16-le', 'surrogatepass')
+
+# 内容能否按 UTF-8 编码（不含单独的代理项）
+def is_valid_text(content):
+    if content.isascii():
+        return True
+    try:
+        content.encode('utf-8')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+# 更新共享索引中某个笔记的 share_id（调用方需持有 cache_lock）
+def set_share_id(identifier, share_id):
+    old_share_id = cache['share_ids'].pop(identifier, None)
+    if old_share_id is not None:
+        cache['share_index'].pop(old_share_id, None)
+    if share_id:
+        cache['share_ids'][identifier] = share_id
+        cache['share_index'][share_id] = identifier
+
+# 通过共享索引把 share_id 解析为笔记 id，索引中没有时（例如其他进程刚创建的共享）查询数据库
+def resolve_share_id(share_id, cache_only=False):
+    with cache_lock:
+        identifier = cache['share_index'].get(share_id)
+    if identifier is not None:
+        metrics.inc('justgetmynote_cache_requests_total', SHARE_INDEX_HIT)
+        return identifier
+    if cache_only:
+        return CACHE_MISS
+    metrics.inc('justgetmynote_cache_requests_total', SHARE_INDEX_MISS)
+    identifier = find_share_id(share_id)
+    if identifier is None:
+        return None
     with cache_lock:
-        return cache['burn_contents'].get(burn_id, None)
+        set_share_id(identifier, share_id)
+    return identifier
+
+# 获取共享笔记的 (内容, 内容哈希)，内容与笔记本身共用同一个缓存条目
+def get_note_by_share_id(share_id, cache_only=False):
+    identifier = resolve_share_id(share_id, cache_only)
+    if identifier is None or identifier is CACHE_MISS:
+        return identifier
+    return get_note(identifier, cache_only)
+
+# SQLite 3.35 起支持 DELETE ... RETURNING，删除与读取可以在一条语句中完成
+DELETE_RETURNING_SUPPORTED = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# 领取阅后即焚内容，同一个 burn_id 只有一个请求能拿到内容，之后的请求返回 None
+# SHARED_DATABASE 为 False 且缓存命中时取出条目并登记墓碑，删除交给删除线程；否则在数据库中原子地删除并返回内容
+# cache_only 为 True 时只使用缓存，需要访问数据库时返回 CACHE_MISS
+def claim_burn_content(burn_id, cache_only=False):
+    with cache_lock:
+        if burn_id in burned_ids:
+            return None
+        content = cache['burn_contents'].pop(burn_id)
+        # 多个进程共用数据库时，其他进程可能在本进程删除之前从数据库领取同一个链接，只能在数据库中领取
+        if content is not None and SHARED_DATABASE:
+            content = None
+        if content is not None:
+            burned_ids.add(burn_id)
+            shard_for(burn_id).burn_delete_queue.put(burn_id)
+    if content is not None:
+        metrics.inc('justgetmynote_cache_requests_total', BURN_HIT)
+        metrics.inc('justgetmynote_burns_claimed_total')
+        return content
+    if cache_only:
+        return CACHE_MISS
+    metrics.inc('justgetmynote_cache_requests_total', BURN_MISS)
+    with db_connection(burn_id) as conn:
+        if DELETE_RETURNING_SUPPORTED:
+            rows = conn.execute('''
+                DELETE FROM burn_contents WHERE burn_id = ?
+                RETURNING (SELECT content FROM blobs WHERE hash = content_hash) AS content,
+                          (SELECT encoding FROM blobs WHERE hash = content_hash) AS encoding
+            ''', (burn_id,)).fetchall()
+        else:
+            # 旧版本的 SQLite 在写事务中先读取再删除
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('''
+                SELECT blobs.content, blobs.encoding FROM burn_contents
+                JOIN blobs ON blobs.hash = burn_contents.content_hash
+                WHERE burn_contents.burn_id = ?
+            ''', (burn_id,)).fetchall()
+            conn.execute('DELETE FROM burn_contents WHERE burn_id = ?', (burn_id,))
+        conn.commit()
+    if not rows:
+        return None
+    logger.info(f"Burn content {burn_id} deleted after access.")
+    metrics.inc('justgetmynote_burns_claimed_total')
+    return decode_blob(rows[0]['content'], rows[0]['encoding'])
+
+# 按路径归类的路由名，用作指标标签（不能直接用路径，否则标签数量无上限）
+ROUTE_PREFIXES = ('share', 'burn', 'update', 'create_share', 'create_burn', 'events', 'history', 'lib', 'meta')
+
+def route_name(path):
+    path = path.lstrip('/')
+    if not path:
+        return 'main'
+    prefix = path.split('/', 1)[0]
+    if '/' in path and prefix in ROUTE_PREFIXES:
+        return prefix
+    if path in ('metrics', 'favicon.ico'):
+        return path
+    if ID_REGEX.fullmatch(path):
+        return 'note'
+    return 'other'
+
+# 记录一次请求的计数和耗时
+def observe_request(path, method, status, duration):
+    route = route_name(path)
+    metrics.inc('justgetmynote_requests_total', (('route', route), ('method', method), ('status', status)))
+    metrics.observe('justgetmynote_request_duration_seconds', duration, (('route', route),))
+
+# 记录一条访问日志，status 和 duration（秒）只出现在 JSON 格式的日志中
+def write_access_log(ip, path, method, status=None, duration=None):
+    log_entry = f"{ip} - {path} - {method}"
+    access = {'ip': ip, 'path': path, 'method': method, 'status': status}
+    if duration is not None:
+        access['duration_ms'] = round(duration * 1000, 3)
+    logger.info(log_entry, extra={'access': access})
 
 # 日志记录装饰器
 def log_request(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        response = f(*args, **kwargs)
-        ip = request.remote_addr
-        path = request.path
-        method = request.method
-        log_entry = f"{ip} - {path} - {method}"
-        logger.info(log_entry)
+        start = time.perf_counter()
+        response = make_response(f(*args, **kwargs))
+        duration = time.perf_counter() - start
+        write_access_log(request.remote_addr, request.path, request.method, response.status_code, duration)
+        observe_request(request.path, request.method, response.status_code, duration)
         return response
     return decorated_function
 
-# 渲染HTML页面
-def render_html(content, read_only=False, path='/', identifier=None, custom_flag=None, construction_mode=False, burn_after_read=False):
-    # 转义内容以确保安全的 HTML 渲染
-    escaped_content = html.escape(content)
+# 超出限流时的 429 响应，Retry-After 为需要等待的整秒数
+def rate_limited_response(path, retry_after):
+    metrics.inc('justgetmynote_rate_limited_total', (('route', route_name(path)),))
+    payload = {'status': 'error', 'message': 'Too many requests, please try again later.'}
+    return Response(json.dumps(payload), status=429, mimetype='application/json',
+                    headers={'Retry-After': str(max(1, int(retry_after + 0.999)))})
+
+# 限流装饰器：按 request.remote_addr 取令牌，ASGI 应用已经检查过的请求不再重复计数
+def rate_limited(limiter):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not request.environ.get('justgetmynote.admitted'):
+                retry_after = limiter.acquire(request.remote_addr)
+                if retry_after:
+                    return rate_limited_response(request.path, retry_after)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+# 页面模板，{readonly}、{flag} 等占位符在启动时按页面类型填好，{content}、{path}、{identifier}、{content_hash} 在渲染时填入
+# 文本框开始标签后的换行会被 HTML 解析器去掉，以换行开头的内容因此能原样显示
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8" />
+<meta name="viewport" content="width=device-width, initial-scale=1.0" />
+<meta name="theme-color" content="#ebeef2" />
+<title>JustGetMyNote</title>
+<meta name="HandheldFriendly" content="True">
+<meta name="MobileOptimized" content="320">
+<meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1, user-scalable=no, minimal-ui, viewport-fit=cover">
+<meta name="format-detection" content="telephone=no" />
+<link href="/lib/abc.css" rel="stylesheet" />
+<link rel="shortcut icon" href="/meta/favicon.png" type="image/png" />
+<link rel="icon" href="/meta/favicon.png" type="image/png" />
+<link rel="apple-touch-icon" href="/meta/app.png" />
+<link rel="apple-touch-icon-precomposed" href="/meta/app.png" />
+<meta name="apple-mobile-web-app-capable" content="yes" />
+<meta name="apple-mobile-web-app-status-bar-style" content="black" />
+<meta name="msapplication-TileColor" content="ebeef2" />
+<meta name="msapplication-TileImage" content="/meta/app.png" />
+<meta name="theme-color" content="#ebeef2">
+<meta property="og:title" content="JustGetMyNote" />
+<meta property="og:site_name" content="JustGetMyNote" />
+<meta property="og:description" content="Take notes with simplicity" />
+<meta property="og:image" content="/meta/app.png" />
+</head>
+<body>
+<div class="stack">
+<div class="layer">
+<div class="layer">
+<div class="layer">
+<textarea id="content" class="content"{readonly} maxlength="100000">
+{content}</textarea>
+</div>
+</div>
+</div>
+<div class="flag">
+{flag}{editor_links}
+</div>
+<pre class="print"></pre>{editor_modal}
+<div id="saveSuccess" class="save-success">√ Saved</div>{page_script}
+</body>
+</html>
+"""
+
+SITE_LINK = '<a href="https://github.com/lightworld689/justgetmynote" target="_blank">JustGetMyNote</a>'
+CONSTRUCTION_FLAG = " - ReadOnly is about to be restored due to construction and website may be temporarily offline"
 
-    # 确定 textarea 是否应为只读
-    readonly_attr = 'readonly' if read_only or construction_mode or burn_after_read else ''
+EDITOR_LINKS = """
+<a href="#" id="shareButton">- [Share]</a> <a href="#" id="burnShareButton">- [Share (Burn after read)]</a>"""
 
-    # 构建 flag 内容
-    if custom_flag:
-        flag = custom_flag
+EDITOR_MODAL = """
+<!-- 阅后即焚弹窗 -->
+<div id="burnModal" class="modal">
+    <div class="modal-content">
+        <span class="close">&times;</span>
+        <p>Burn after read link:</p>
+        <a id="burnLink" href="#" target="_blank">Link will appear here</a>
+    </div>
+</div>"""
+
+EDITOR_SCRIPT = """
+<script>
+    const identifier = '{identifier}';
+    const contentHash = '{content_hash}';
+</script>
+<script src="/lib/abc.js"></script>"""
+
+LIVE_SCRIPT = """
+<script>
+    const contentHash = '{content_hash}';
+</script>
+<script src="/lib/live.js"></script>"""
+
+RENDER_CHUNK_CHARS = 16 * 1024      # 流式输出时每次转义的字符数
+RENDER_STREAM_THRESHOLD = 64 * 1024  # 超过该字符数的内容以流的形式输出，否则一次性输出并带上 Content-Length
+
+# 按页面类型（note、main、share、burn）和是否处于维护模式预先拆分好的模板：
+# 在 {content}、{path}、{identifier}、{content_hash} 处切开的字节块列表
+def build_page_template(kind, construction_mode):
+    editable = kind == 'note' and not construction_mode
+    if kind == 'share':
+        flag = SITE_LINK + ' - Shared with you - ReadOnly'
     else:
-        escaped_path = html.escape(path)
-        flag = f'''
-        <a href="https://github.com/lightworld689/justgetmynote" target="_blank">JustGetMyNote</a> - {escaped_path}
-        '''
-        if read_only:
-            flag += " - ReadOnly"
-
-    # 如果处于维护模式，添加额外的信息
+        flag = SITE_LINK + ' - {path}'
+        if not editable:
+            flag += ' - ReadOnly'
     if construction_mode:
-        flag += " - ReadOnly is about to be restored due to construction and website may be temporarily offline"
-
-    # 如果是阅后即焚页面，追加标识
-    if burn_after_read:
-        flag += " - Burn after read"
-
-    # 构建 HTML 内容
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-    <meta charset="utf-8" />
-    <meta name="viewport" content="width=device-width, initial-scale=1.0" />
-    <meta name="theme-color" content="#ebeef2" />
-    <title>JustGetMyNote</title>
-    <meta name="HandheldFriendly" content="True">
-    <meta name="MobileOptimized" content="320">
-    <meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1, user-scalable=no, minimal-ui, viewport-fit=cover">
-    <meta name="format-detection" content="telephone=no" />
-    <link href="/lib/abc.css" rel="stylesheet" />
-    <link rel="shortcut icon" href="/meta/favicon.png" type="image/png" />
-    <link rel="icon" href="/meta/favicon.png" type="image/png" />
-    <link rel="apple-touch-icon" href="/meta/app.png" />
-    <link rel="apple-touch-icon-precomposed" href="/meta/app.png" />
-    <meta name="apple-mobile-web-app-capable" content="yes" />
-    <meta name="apple-mobile-web-app-status-bar-style" content="black" />
-    <meta name="msapplication-TileColor" content="ebeef2" />
-    <meta name="msapplication-TileImage" content="/meta/app.png" />
-    <meta name="theme-color" content="#ebeef2">
-    <meta property="og:title" content="JustGetMyNote" />
-    <meta property="og:site_name" content="JustGetMyNote" />
-    <meta property="og:description" content="Take notes with simplicity" />
-    <meta property="og:image" content="/meta/app.png" />
-    </head>
-    <body>
-    <div class="stack">
-    <div class="layer">
-    <div class="layer">
-    <div class="layer">
-    <textarea id="content" class="content" {readonly_attr} maxlength="100000">{escaped_content}</textarea>
-    </div>
-    </div>
-    </div>
-    <div class="flag">
-    {flag}
-    {'''
-    <a href="#" id="shareButton">- [Share]</a> <a href="#" id="burnShareButton">- [Share (Burn after read)]</a>
-    ''' if not read_only and not construction_mode and not burn_after_read else ''}
-    </div>
-    <pre class="print"></pre>
-    {'''
-    <!-- 阅后即焚弹窗 -->
-    <div id="burnModal" class="modal">
-        <div class="modal-content">
-            <span class="close">&times;</span>
-            <p>Burn after read link:</p>
-            <a id="burnLink" href="#" target="_blank">Link will appear here</a>
-        </div>
-    </div>
-    ''' if not read_only and not construction_mode and not burn_after_read else ''}
-    <div id="saveSuccess" class="save-success">√ Saved</div>
-    {'' if read_only or construction_mode or burn_after_read else f'''
-    <script>
-        const identifier = '{html.escape(identifier)}';
-    </script>
-    <script src="/lib/abc.js"></script>
-    '''}
-    </body>
-    </html>
-    """
-
-    return Response(html_content, mimetype='text/html')
+        flag += CONSTRUCTION_FLAG
+    if kind == 'burn':
+        flag += ' - Burn after read'
+    page = PAGE_TEMPLATE.format(
+        readonly='' if editable else ' readonly',
+        flag=flag,
+        editor_links=EDITOR_LINKS if editable else '',
+        editor_modal=EDITOR_MODAL if editable else '',
+        # 可编辑页面加载编辑脚本，只读的笔记和共享页面加载实时更新脚本
+        page_script=EDITOR_SCRIPT if editable else LIVE_SCRIPT if kind in ('note', 'share') else '',
+        content='{content}',
+    )
+    return [part.encode('utf-8') for part in re.split(r'(\{content\}|\{path\}|\{identifier\}|\{content_hash\})', page)]
+
+PAGE_TEMPLATES = {
+    (kind, construction_mode): build_page_template(kind, construction_mode)
+    for kind in ('note', 'main', 'share', 'burn')
+    for construction_mode in (False, True)
+}
+
+# 按模板依次输出页面的字节块，内容分段转义，不会生成整页字符串
+def iter_page(template, content, fields):
+    for part in template:
+        if part == b'{content}':
+            for i in range(0, len(content), RENDER_CHUNK_CHARS):
+                yield html.escape(content[i:i + RENDER_CHUNK_CHARS]).encode('utf-8')
+        elif part in fields:
+            yield fields[part]
+        else:
+            yield part
+
+# 渲染HTML页面
+def render_html(kind, content, path='', identifier='', content_hash='', construction_mode=False, encoding=None):
+    template = PAGE_TEMPLATES[(kind, construction_mode)]
+    fields = {
+        b'{path}': html.escape(path).encode('utf-8'),
+        b'{identifier}': html.escape(identifier).encode('utf-8'),
+        # 文本框会把 \r\n 规范化为 \n，这样的内容在浏览器中与哈希对应的版本不一致，不能作为补丁基准
+        b'{content_hash}': (content_hash if '\r' not in content else '').encode('ascii'),
+    }
+    chunks = iter_page(template, content, fields)
+    if encoding is not None:
+        return Response(compress_body(b''.join(chunks), encoding), mimetype='text/html', headers={'Content-Encoding': encoding})
+    if len(content) > RENDER_STREAM_THRESHOLD:
+        return Response(chunks, mimetype='text/html')
+    return Response(b''.join(chunks), mimetype='text/html')
+
+# 模板本身的版本，模板改动后旧的 ETag 全部失效
+TEMPLATE_TAG = content_hash(repr(sorted(PAGE_TEMPLATES.items())))[:8]
+
+# 按压缩编码压缩响应体
+def compress_body(body, encoding, static=False):
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if static else 5)
+    return gzip.compress(body, compresslevel=9 if static else 6, mtime=0)
+
+# 根据 Accept-Encoding 选择压缩编码，客户端不支持时返回 None
+def choose_encoding(headers):
+    accept_encodings = parse_accept_header(headers.get('Accept-Encoding'))
+    return accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+
+# 客户端缓存的版本仍然有效时直接返回 304，不再渲染；两种响应都带上 ETag 和 Cache-Control
+# 较大的页面按客户端支持的编码压缩，首页和共享页面的压缩结果按内容版本缓存
+def render_page(kind, content, digest, cache_control, headers, construction_mode=False, **fields):
+    etag = f'{digest}-{TEMPLATE_TAG}' + ('-c' if construction_mode else '')
+    encoding = choose_encoding(headers) if len(content) >= COMPRESS_MIN_CHARS else None
+    if parse_etags(headers.get('If-None-Match')).contains_weak(etag):
+        response = Response(status=304)
+    elif encoding is not None and kind in ('main', 'share'):
+        key = (kind, fields.get('path', ''), etag, encoding)
+        with cache_lock:
+            body = compressed_pages.get(key)
+        metrics.inc('justgetmynote_cache_requests_total', COMPRESSED_MISS if body is None else COMPRESSED_HIT)
+        if body is None:
+            body = render_html(kind, content, content_hash=digest, construction_mode=construction_mode, encoding=encoding, **fields).get_data()
+            with cache_lock:
+                compressed_pages[key] = body
+        response = Response(body, mimetype='text/html', headers={'Content-Encoding': encoding})
+    else:
+        response = render_html(kind, content, content_hash=digest, construction_mode=construction_mode, encoding=encoding, **fields)
+    response.vary.add('Accept-Encoding')
+    # 页面可能被压缩传输，使用弱 ETag
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+PUBLIC_CACHE_CONTROL = f'public, max-age={PUBLIC_PAGE_MAX_AGE}, must-revalidate'
 
 # 主路由，处理 /,  /share/<share_id>, /burn/<burn_id>, /<id>, /
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 @log_request
 def serve_content(path):
+    return content_response(path, request.headers)
+
+# 生成 /、/share/<share_id>、/burn/<burn_id>、/<id> 的响应
+# cache_only 为 True 时只使用缓存，需要访问数据库时返回 None
+def content_response(path, headers, cache_only=False):
     construction_mode = is_construction_mode()
 
     # 处理主路由
     if path in ['']:
         with cache_lock:
             content = cache['main_text']
+            digest = cache['main_hash']
         display_path = '/' if path == '' else f'/{path}'
         # 在维护模式下，页面仍然是只读的
-        return render_html(content, read_only=True, path=display_path, construction_mode=construction_mode)
+        return render_page('main', content, digest, PUBLIC_CACHE_CONTROL, headers, construction_mode=construction_mode, path=display_path)
 
     # 处理 /share/<share_id> 路由
     if path.startswith('share/'):
         share_id = path.split('share/')[1]
         if not SHARE_ID_REGEX.fullmatch(share_id):
-            return "Invalid Share ID", 400
-        content = get_content_by_share_id(share_id)
+            return Response("Invalid Share ID", status=400)
+        entry = get_note_by_share_id(share_id, cache_only)
+        if entry is CACHE_MISS:
+            return None
+        content, digest = entry or ("", EMPTY_CONTENT_HASH)
         if not content:
-            return "Share ID not found", 404
-        flag = '''
-            <a href="https://github.com/lightworld689/justgetmynote" target="_blank">JustGetMyNote</a> - Shared with you - ReadOnly
-        '''
-        if construction_mode:
-            flag += " - ReadOnly is about to be restored due to construction and website may be temporarily offline"
-        return render_html(content, read_only=True, path=f'/share/{share_id}', custom_flag=flag, construction_mode=construction_mode)
+            return Response("Share ID not found", status=404)
+        return render_page('share', content, digest, PUBLIC_CACHE_CONTROL, headers, construction_mode=construction_mode)
 
     # 处理 /burn/<burn_id> 路由
     if path.startswith('burn/'):
         burn_id = path.split('burn/')[1]
         if not BURN_ID_REGEX.fullmatch(burn_id):
-            return "Invalid Burn ID", 400
-        content = get_content_by_burn_id(burn_id)
+            return Response("Invalid Burn ID", status=400)
+        content = claim_burn_content(burn_id, cache_only)
+        if content is CACHE_MISS:
+            return None
         if not content:
-            return "Burn ID not found or already burned", 404
+            return Response("Burn ID not found or already burned", status=404)
 
         # 渲染内容，并设置 burn_after_read 标志
-        response = render_html(content, read_only=True, path=f'/burn/{burn_id}', burn_after_read=True, construction_mode=construction_mode)
-
-        # 渲染后，从数据库和缓存中删除 burn_id
-        def delete_burn_content(burn_id_to_delete):
-            try:
-                conn = get_db_connection()
-                c = conn.cursor()
-                c.execute('DELETE FROM burn_contents WHERE burn_id = ?', (burn_id_to_delete,))
-                conn.commit()
-                conn.close()
-                with cache_lock:
-                    cache['burn_contents'].pop(burn_id_to_delete, None)
-                logger.info(f"Burn content {burn_id_to_delete} deleted after access.")
-            except Exception as e:
-                logger.error(f"Error deleting burn content {burn_id_to_delete}: {e}")
-
-        # 启动线程在响应后删除烧毁内容
-        delete_thread = threading.Thread(target=delete_burn_content, args=(burn_id,), daemon=True)
-        delete_thread.start()
-
+        response = render_html('burn', content, path=f'/burn/{burn_id}', construction_mode=construction_mode)
+        # 阅后即焚的内容不能被任何缓存保存
+        response.headers['Cache-Control'] = 'no-store'
         return response
 
     # 处理 /<id> 路由
     if ID_REGEX.fullmatch(path):
         identifier = path
-        with cache_lock:
-            content = cache['contents'].get(identifier, "")
+        entry = get_note(identifier, cache_only)
+        if entry is CACHE_MISS:
+            return None
+        content, digest = entry or ("", EMPTY_CONTENT_HASH)
         display_path = f'/{identifier}'
-        # 如果处于维护模式，将页面设置为只读
-        read_only = construction_mode
-        return render_html(content, read_only=read_only, path=display_path, identifier=identifier, construction_mode=construction_mode)
+        # 如果处于维护模式，模板会将页面设置为只读
+        # 可编辑页面每次都需要重新验证，避免编辑者拿到旧内容
+        return render_page('note', content, digest, 'private, no-cache', headers, construction_mode=construction_mode, path=display_path, identifier=identifier)
 
     # 如果路由不匹配，返回 404
-    return "404 Not Found<br />Maybe try 1-24 digit letters and numbers?", 404
+    return Response("404 Not Found<br />Maybe try 1-24 digit letters and numbers?", status=404)
 
 # 更新内容的 API
 @app.route('/update/<identifier>', methods=['POST'])
 @log_request
+@rate_limited(update_limiter)
 def update(identifier):
+    payload, status = apply_update(identifier, request.get_json(silent=True))
+    return jsonify(payload), status
+
+# 处理一次内容更新，返回 (响应内容, 状态码)
+# cache_only 为 True 时只使用缓存，增量补丁的基准不在缓存中时返回 None
+def apply_update(identifier, data, cache_only=False):
     construction_mode = is_construction_mode()
     if construction_mode:
-        return jsonify({'status': 'error', 'message': 'The site is under maintenance and content cannot be modified.'}), 503
+        return {'status': 'error', 'message': 'The site is under maintenance and content cannot be modified.'}, 503
 
     # 验证标识符
     if not ID_REGEX.fullmatch(identifier):
-        return jsonify({'status': 'error', 'message': 'Invalid identifier.'}), 400
-
-    # 获取新内容
-    data = request.get_json()
-    if not data or 'content' not in data:
-        return jsonify({'status': 'error', 'message': 'Lack of content.'}), 400
+        return {'status': 'error', 'message': 'Invalid identifier.'}, 400
+
+    # 获取新内容：完整内容 {'content': ...}，或基于某个版本的增量 {'base': 哈希, 'patch': [start, end, text]}
+    if not isinstance(data, dict) or ('content' not in data and 'patch' not in data):
+        return {'status': 'error', 'message': 'Lack of content.'}, 400
+
+    base = None
+    if 'patch' in data:
+        base = data.get('base')
+        entry = get_note(identifier, cache_only)
+        if entry is CACHE_MISS:
+            return None
+        current_content, current_hash = entry or ("", EMPTY_CONTENT_HASH)
+        if base != current_hash:
+            # 客户端的基准版本已过期，要求其改为上传完整内容
+            return {'status': 'error', 'code': 'base_mismatch', 'message': 'Base version mismatch, full content required.'}, 409
+        try:
+            new_content = apply_patch(current_content, data['patch'])
+        except ValueError as e:
+            return {'status': 'error', 'message': str(e)}, 400
+    else:
+        new_content = data['content']
+        if not isinstance(new_content, str):
+            return {'status': 'error', 'message': 'Lack of content.'}, 400
 
-    new_content = data['content']
+    # 含有单独代理项的内容（包括补丁切开代理对的结果）无法按 UTF-8 输出页面，拒绝保存
+    if not is_valid_text(new_content):
+        return {'status': 'error', 'message': 'Content is not valid Unicode text.'}, 400
 
     # 检查内容长度
     if len(new_content) > 100000:
-        return jsonify({'status': 'error', 'message': 'Content length exceeds the 100,000 character limit.'}), 400
+        return {'status': 'error', 'message': 'Content length exceeds the 100,000 character limit.'}, 400
 
-    # 将写入任务加入队列
-    write_queue.put((identifier, new_content))
+    new_hash = content_hash(new_content)
 
     # 立即更新缓存
     with cache_lock:
-        cache['contents'][identifier] = new_content
+        # 应用补丁期间内容被其他请求改动过，同样要求上传完整内容
+        if base is not None:
+            entry = cache['contents'].get(identifier)
+            if entry is not None and entry[1] != base:
+                return {'status': 'error', 'code': 'base_mismatch', 'message': 'Base version mismatch, full content required.'}, 409
+        # 先登记为未写入的编辑，再加入队列，缓存刷新不会用旧行覆盖它
+        pending_writes[identifier] = new_content
+        shard_for(identifier).write_queue.put((identifier, new_content))
+        cache['contents'][identifier] = (new_content, new_hash)
+        cache['generation'] += 1
         if identifier == 'main':
             cache['main_text'] = new_content
+            cache['main_hash'] = new_hash
+        # 共享页面通过共享索引读取同一个缓存条目，无需再单独更新
+        # 在锁内发布，保证订阅者收到的版本顺序与缓存一致
+        event_hub.publish(identifier, new_hash, new_content, base, data.get('patch') if base is not None else None)
+
+    return {'status': 'success', 'hash': new_hash}, 200
+
+# 打开 /events/<id> 或 /events/share/<share_id> 的订阅，参数无效或共享链接不存在时返回错误响应
+# known_hash 是客户端已有的版本，与当前版本不一致时先补发一次完整内容
+def open_event_stream(target, known_hash, notify):
+    if target.startswith('share/'):
+        share_id = target[len('share/'):]
+        if not SHARE_ID_REGEX.fullmatch(share_id):
+            return Response("Invalid Share ID", status=400)
+        identifier = resolve_share_id(share_id)
+        if identifier is None:
+            return Response("Share ID not found", status=404)
+    elif ID_REGEX.fullmatch(target):
+        identifier = target
+    else:
+        return Response("Invalid identifier", status=400)
+    # 先订阅再读取当前版本，两者之间发生的修改也不会漏掉
+    subscriber = event_hub.subscribe(identifier, known_hash, notify)
+    content, digest = get_note(identifier) or ("", EMPTY_CONTENT_HASH)
+    if digest != known_hash:
+        event_hub.offer(subscriber, digest, content)
+    return subscriber
+
+EVENT_STREAM_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',  # 禁止反向代理缓冲事件流
+}
 
-        # 检查是否有对应的 share_id，并更新 share_contents 缓存
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('SELECT share_id FROM contents WHERE id = ?', (identifier,))
-        row = c.fetchone()
-        conn.close()
-        if row and row['share_id']:
-            share_id = row['share_id']
-            cache['share_contents'][share_id] = new_content
-
-    return jsonify({'status': 'success'})
+# 笔记实时更新的事件流（Server-Sent Events），共享页面的事件流不会暴露笔记 id
+@app.route('/events/<path:target>')
+@log_request
+def events(target):
+    wakeup = threading.Event()
+    known_hash = request.headers.get('Last-Event-ID') or request.args.get('hash', '')
+    result = open_event_stream(target, known_hash, wakeup.set)
+    if isinstance(result, Response):
+        return result
+    return Response(iter_events(result, wakeup), mimetype='text/event-stream', headers=EVENT_STREAM_HEADERS)
+
+# 逐条输出事件，空闲时发送心跳；连接断开后生成器被关闭，随之取消订阅
+def iter_events(subscriber, wakeup):
+    try:
+        yield f'retry: {SSE_RETRY_MS}\n\n'.encode('ascii')
+        while True:
+            if wakeup.wait(SSE_HEARTBEAT_INTERVAL):
+                wakeup.clear()
+                message = event_hub.take(subscriber)
+                if message is not None:
+                    yield message
+            else:
+                yield b': ping\n\n'
+    finally:
+        event_hub.unsubscribe(subscriber)
 
 # 创建共享链接的 API
 @app.route('/create_share/<identifier>', methods=['POST'])
 @log_request
+@rate_limited(create_limiter)
 def create_share(identifier):
     construction_mode = is_construction_mode()
     if construction_mode:
@@ -926,35 +2508,36 @@ def create_share(identifier):
     if not ID_REGEX.fullmatch(identifier):
         return jsonify({'status': 'error', 'message': 'Invalid identifier.'}), 400
 
-    with cache_lock:
-        content = cache['contents'].get(identifier, None)
+    content = get_content_by_id(identifier)
 
     if content is None:
         return jsonify({'status': 'error', 'message': 'The identifier does not exist.'}), 404
 
-    conn = get_db_connection()
-    c = conn.cursor()
-
     # 检查是否已经存在 share_id
-    c.execute('SELECT share_id FROM contents WHERE id = ?', (identifier,))
-    row = c.fetchone()
-    if row and row['share_id']:
-        share_id = row['share_id']
-    else:
+    with cache_lock:
+        share_id = cache['share_ids'].get(identifier)
+
+    if share_id is None:
         # 生成唯一的 share_id
         share_id = generate_share_id()
         try:
-            c.execute('UPDATE contents SET share_id = ? WHERE id = ?', (share_id, identifier))
-            conn.commit()
+            with db_connection(identifier) as conn:
+                # 笔记可能还在写入队列中尚未落盘，此时连同当前内容一起插入
+                digest = store_blob(conn, content)
+                conn.execute('''
+                    INSERT INTO contents (id, content_hash, share_id) VALUES (?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET share_id = excluded.share_id
+                    WHERE contents.share_id IS NULL
+                ''', (identifier, digest, share_id))
+                conn.commit()
+                row = conn.execute('SELECT share_id FROM contents WHERE id = ?', (identifier,)).fetchone()
         except sqlite3.IntegrityError:
-            conn.close()
             return jsonify({'status': 'error', 'message': '生成的 share_id 冲突，请重试。'}), 500
-
-    conn.close()
-
-    # 更新缓存中的 share_contents
-    with cache_lock:
-        cache['share_contents'][share_id] = content
+        # 其他进程可能已经先为该笔记创建了共享，以数据库中的为准
+        share_id = row['share_id']
+        with cache_lock:
+            set_share_id(identifier, share_id)
+        metrics.inc('justgetmynote_shares_created_total')
 
     share_url = f"/share/{share_id}"
     return jsonify({'status': 'success', 'share_url': share_url})
@@ -962,6 +2545,7 @@ def create_share(identifier):
 # 创建阅后即焚共享链接的 API
 @app.route('/create_burn/<identifier>', methods=['POST'])
 @log_request
+@rate_limited(create_limiter)
 def create_burn(identifier):
     construction_mode = is_construction_mode()
     if construction_mode:
@@ -971,35 +2555,86 @@ def create_burn(identifier):
     if not ID_REGEX.fullmatch(identifier):
         return jsonify({'status': 'error', 'message': 'Invalid identifier.'}), 400
 
-    with cache_lock:
-        content = cache['contents'].get(identifier, None)
+    entry = get_note(identifier)
 
-    if content is None:
+    if entry is None:
         return jsonify({'status': 'error', 'message': 'The identifier does not exist.'}), 404
+    content, digest = entry
 
     # 生成唯一的 burn_id
     burn_id = generate_burn_id()
 
-    # 插入到 burn_contents 表
+    # 插入到 burn_contents 表，只引用内容哈希，同一笔记的多个链接共用一份内容（分片模式下内容保存在 burn_id 所在的分片）
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('INSERT INTO burn_contents (burn_id, content) VALUES (?, ?)', (burn_id, content))
-        conn.commit()
-        conn.close()
+        with db_connection(burn_id) as conn:
+            store_blob(conn, content, digest)
+            conn.execute('INSERT INTO burn_contents (burn_id, content_hash) VALUES (?, ?)', (burn_id, digest))
+            conn.commit()
     except sqlite3.IntegrityError:
         return jsonify({'status': 'error', 'message': '生成的 burn_id 冲突，请重试。'}), 500
     except Exception as e:
         logger.error(f"Error creating burn content: {e}")
         return jsonify({'status': 'error', 'message': 'Internal server error.'}), 500
 
-    # 更新缓存中的 burn_contents
+    # 更新缓存中的 burn_contents（与笔记的缓存条目共用同一个字符串对象）
     with cache_lock:
         cache['burn_contents'][burn_id] = content
+    metrics.inc('justgetmynote_burns_created_total')
 
     burn_url = f"/burn/{burn_id}"
     return jsonify({'status': 'success', 'burn_url': burn_url})
 
+# 列出笔记的历史版本（从新到旧）
+@app.route('/history/<identifier>')
+@log_request
+def history(identifier):
+    if not ID_REGEX.fullmatch(identifier):
+        return jsonify({'status': 'error', 'message': 'Invalid identifier.'}), 400
+    with db_connection(identifier) as conn:
+        rows = conn.execute('SELECT rev, created_at, content_hash FROM revisions WHERE id = ? ORDER BY rev DESC', (identifier,)).fetchall()
+    revisions = [{'rev': row['rev'], 'created_at': row['created_at'], 'hash': row['content_hash']} for row in rows]
+    return jsonify({'status': 'success', 'revisions': revisions})
+
+# 获取笔记某个历史版本的内容
+@app.route('/history/<identifier>/<int:rev>')
+@log_request
+def history_revision(identifier, rev):
+    if not ID_REGEX.fullmatch(identifier):
+        return jsonify({'status': 'error', 'message': 'Invalid identifier.'}), 400
+    result = get_revision(identifier, rev)
+    if result is None:
+        return jsonify({'status': 'error', 'message': 'The revision does not exist.'}), 404
+    row, content = result
+    return jsonify({'status': 'success', 'rev': row['rev'], 'created_at': row['created_at'], 'hash': row['content_hash'], 'content': content})
+
+# Prometheus 指标
+@app.route('/metrics')
+@log_request
+def metrics_endpoint():
+    if METRICS_LOCAL_ONLY and request.remote_addr not in ('127.0.0.1', '::1'):
+        return Response('Forbidden', status=403)
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# 汇总计数器、直方图和抓取时读取的队列深度、缓存大小
+def render_metrics():
+    with cache_lock:
+        caches = (('contents', cache['contents']), ('burn_contents', cache['burn_contents']), ('compressed_pages', compressed_pages))
+        cache_entries = [((('cache', name),), len(lru)) for name, lru in caches]
+        cache_bytes = [((('cache', name),), lru.total_bytes) for name, lru in caches]
+        share_count = len(cache['share_index'])
+        pending_count = len(pending_writes)
+    gauges = [
+        ('justgetmynote_cache_entries', 'Entries in each in-memory cache.', cache_entries + [((('cache', 'share_index'),), share_count)]),
+        ('justgetmynote_cache_bytes', 'Estimated memory used by each LRU cache.', cache_bytes),
+        ('justgetmynote_write_queue_depth', 'Edits waiting in the write queue.', [((), sum(shard.write_queue.qsize() for shard in shards))]),
+        ('justgetmynote_pending_writes', 'Notes with edits not yet committed to the database.', [((), pending_count)]),
+        ('justgetmynote_burn_delete_queue_depth', 'Claimed burn links waiting to be deleted.', [((), sum(shard.burn_delete_queue.qsize() for shard in shards))]),
+        ('justgetmynote_log_queue_depth', 'Log records waiting to be written.', [((), log_queue.qsize())]),
+        ('justgetmynote_log_dropped', 'Log records dropped because the log queue was full.', [((), log_handler.dropped)]),
+        ('justgetmynote_event_subscribers', 'Open live-update streams.', [((), event_hub.subscriber_count())]),
+    ]
+    return metrics.render(gauges)
+
 # 提供静态文件（如 /meta/bg.png）
 @app.route('/meta/<path:filename>')
 @log_request
@@ -1010,7 +2645,27 @@ def meta_static(filename):
 @app.route('/lib/<path:filename>')
 @log_request
 def lib_static(filename):
-    return send_from_directory('lib', filename)
+    response = static_response(filename, request.headers)
+    if response is None:
+        return send_from_directory('lib', filename)
+    return response
+
+# 返回预先压缩好的 lib 静态文件，不在 static_assets 中的文件返回 None
+def static_response(filename, headers):
+    variants = static_assets.get(filename)
+    if variants is None:
+        return None
+    if parse_etags(headers.get('If-None-Match')).contains_weak(variants['etag']):
+        response = Response(status=304)
+    else:
+        encoding = choose_encoding(headers)
+        response = Response(variants.get(encoding, variants['identity']), mimetype=variants['mimetype'])
+        if encoding in variants:
+            response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(variants['etag'], weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 # 提供 favicon.ico
 @app.route('/favicon.ico')
@@ -1023,40 +2678,18 @@ def favicon():
 
 # 缓存更新线程函数
 def update_cache():
+    last_revision_prune = 0
     while True:
         try:
-            # 更新 main.txt
-            if os.path.exists(MAIN_TEXT_FILE):
-                with open(MAIN_TEXT_FILE, 'r', encoding='utf-8') as f:
-                    main_text = f.read()
-                with cache_lock:
-                    cache['main_text'] = main_text
-            else:
-                with cache_lock:
-                    cache['main_text'] = ""
-
-            # 更新 settings/main.txt
-            if os.path.exists(MAIN_SETTINGS_FILE):
-                with open(MAIN_SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                    settings = {}
-                    for line in f:
-                        line = line.strip()
-                        if line.startswith('#') or not line:
-                            continue
-                        if '=' in line:
-                            key, value = line.split('=', 1)
-                            key = key.strip().lower()
-                            value = value.strip().lower()
-                            if key == 'construction':
-                                settings['construction'] = (value == 'true')
-                    with cache_lock:
-                        cache['settings'] = settings
-            else:
-                with cache_lock:
-                    cache['settings'] = {}
-
-            # 更新所有内容到缓存
-            load_all_contents_to_cache()
+            # main.txt 和 settings/main.txt 由 settings_watcher 在变化时重新加载
+            # 数据库的修改由 watch_data_version 立即同步，这里的刷新只是兜底
+            timed_refresh()
+            cleanup_database()
+
+            # 定期清理过期的历史版本
+            if time.monotonic() - last_revision_prune >= REVISION_PRUNE_INTERVAL:
+                last_revision_prune = time.monotonic()
+                prune_revisions()
             # 输出多了容易撑爆控制台
             # print("缓存已更新。")
         except Exception as e:
@@ -1064,94 +2697,868 @@ def update_cache():
         # 等待10秒
         time.sleep(10)
 
-# 写入队列处理线程函数
-def process_write_queue():
+# 写入队列处理线程函数（每个分片一个）：有编辑入队时立即唤醒，按数量或延迟阈值分组提交
+def process_write_queue(shard):
+    write_queue = shard.write_queue
     while True:
+        # 阻塞等待第一条写入任务
+        identifier, new_content = write_queue.get()
+        # 同一标识符只保留最新的内容
+        writes = {identifier: new_content}
+        batch_size = get_setting('write_batch_size')
+        deadline = time.monotonic() + get_setting('write_flush_latency')
+        while len(writes) < batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                identifier, new_content = write_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            writes[identifier] = new_content
+        write_batch(shard, writes)
+
+# 提交同一分片中的一批编辑；整批失败时逐条重试，其他笔记的编辑照常提交，不会被一条无法写入的编辑拖住
+# 因数据本身无法写入的编辑记录日志后丢弃
+def write_batch(shard, writes):
+    try:
+        flush_until_stored(shard, writes)
+        return
+    except Exception as e:
+        logger.error(f"处理写入队列时出错: {e}")
+    for identifier, new_content in writes.items():
         try:
-            writes = []
-            while not write_queue.empty():
-                write_task = write_queue.get_nowait()
-                writes.append(write_task)
-            if writes:
-                conn = get_db_connection()
-                c = conn.cursor()
-                for identifier, new_content in writes:
-                    try:
-                        # 尝试更新已有的内容
-                        c.execute('''
-                            UPDATE contents SET content = ? WHERE id = ?
-                        ''', (new_content, identifier))
-                        if c.rowcount == 0:
-                            # 如果没有更新到任何行，说明标识符不存在，插入新的记录
-                            c.execute('''
-                                INSERT INTO contents (id, content) VALUES (?, ?)
-                            ''', (identifier, new_content))
-                    except sqlite3.IntegrityError as e:
-                        logger.error(f"数据库错误: {e}")
-                conn.commit()
-                conn.close()
+            flush_until_stored(shard, {identifier: new_content})
         except Exception as e:
-            logger.error(f"处理写入队列时出错: {e}")
-        # 等待10秒
-        time.sleep(10)
+            logger.error(f"写入 {identifier} 失败，已丢弃该编辑: {e}")
+            discard_write(identifier, new_content)
+
+# 提交编辑；数据库被锁、磁盘已满等暂时性错误（OperationalError）时原地等待后重试，不丢弃编辑
+def flush_until_stored(shard, writes):
+    while True:
+        try:
+            flush_shard_writes(shard, writes)
+            return
+        except sqlite3.OperationalError as e:
+            logger.error(f"写入数据库暂时失败，{WRITE_RETRY_DELAY} 秒后重试: {e}")
+            time.sleep(WRITE_RETRY_DELAY)
+
+# 丢弃无法写入的编辑：移除未写入标记，缓存中的条目也一并移除，之后的读取回到数据库中的版本
+def discard_write(identifier, new_content):
+    with cache_lock:
+        # 期间已有更新的编辑时保留它
+        if pending_writes.get(identifier) is not new_content:
+            return
+        del pending_writes[identifier]
+        cache['contents'].pop(identifier, None)
+        cache['generation'] += 1
+
+# 计算从 old 到 new 的单段替换 [start, end, text]（按 Python 字符下标），用二分比较切片求公共前后缀
+def compute_splice(old, new):
+    lo, hi = 0, min(len(old), len(new))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[:mid] == new[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    start = lo
+    lo, hi = 0, min(len(old), len(new)) - start
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if old[len(old) - mid:] == new[len(new) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return [start, len(old) - lo, new[start:len(new) - lo]]
+
+# 把先后两次单段替换合并为一次：first 作用于 S0 得到 S1，second 作用于 S1 得到 new
+def merge_splices(first, second, new):
+    start1, end1, text1 = first
+    start2, end2, text2 = second
+    start = min(start1, start2)
+    end_in_s1 = max(start1 + len(text1), end2)
+    end = end_in_s1 - len(text1) + (end1 - start1)
+    return [start, end, new[start:end_in_s1 + len(text2) - (end2 - start2)]]
+
+# 在写入事务中为一批笔记记录历史版本，writes 为 [(id, 新内容, 内容哈希)]
+# 需在更新 contents 之前调用：contents 中的当前内容就是最新历史版本的内容，用作增量的基准
+def record_revisions(conn, writes):
+    now = int(time.time())
+    rows = fetch_rows_by_keys(conn.cursor(), '''
+        SELECT contents.id, contents.content_hash, blobs.content, blobs.encoding,
+               revisions.rev, revisions.chain, revisions.created_at,
+               revisions.content_hash AS rev_hash, revisions.data AS rev_data
+        FROM contents
+        JOIN blobs ON blobs.hash = contents.content_hash
+        LEFT JOIN revisions ON revisions.id = contents.id
+            AND revisions.rev = (SELECT MAX(rev) FROM revisions AS latest WHERE latest.id = contents.id)
+        WHERE contents.id IN ({})
+    ''', [identifier for identifier, _, _ in writes])
+    previous = {row['id']: row for row in rows}
+    inserts = []
+    updates = []
+    for identifier, new_content, digest in writes:
+        row = previous.get(identifier)
+        if row is None:
+            inserts.append((identifier, 1, now, digest, 0, *encode_blob(new_content)))
+            continue
+        if row['content_hash'] == digest:
+            continue
+        old_content = decode_blob(row['content'], row['encoding'])
+        rev, chain = row['rev'], row['chain']
+        if rev is None or row['rev_hash'] != row['content_hash']:
+            # 还没有历史或历史与当前内容不一致（例如被外部工具修改过），先保存当前内容的快照
+            rev = (rev or 0) + 1
+            chain = 0
+            inserts.append((identifier, rev, now, row['content_hash'], 0, *encode_blob(old_content)))
+        splice = compute_splice(old_content, new_content)
+        # 最新版本是不久前的增量时把这次修改合并进去，不为每次自动保存都新增版本
+        if chain > 0 and now - row['created_at'] < REVISION_COALESCE_SECONDS:
+            merged = merge_splices(json.loads(row['rev_data']), splice, new_content)
+            if len(merged[2]) * 2 <= len(new_content):
+                updates.append((digest, json.dumps(merged), identifier, rev))
+                continue
+        if chain + 1 < REVISION_SNAPSHOT_INTERVAL and len(splice[2]) * 2 <= len(new_content):
+            inserts.append((identifier, rev + 1, now, digest, chain + 1, json.dumps(splice), 'plain'))
+        else:
+            inserts.append((identifier, rev + 1, now, digest, 0, *encode_blob(new_content)))
+    conn.executemany('''
+        INSERT INTO revisions (id, rev, created_at, content_hash, chain, data, encoding)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', inserts)
+    conn.executemany('UPDATE revisions SET content_hash = ?, data = ? WHERE id = ? AND rev = ?', updates)
+
+# 从最近的快照开始依次应用增量，重建笔记的某个历史版本，返回 (版本行, 内容)，不存在时返回 None
+def get_revision(identifier, rev):
+    with db_connection(identifier) as conn:
+        rows = conn.execute('''
+            SELECT rev, created_at, content_hash, chain, data, encoding FROM revisions
+            WHERE id = ? AND rev <= ?
+              AND rev >= (SELECT MAX(rev) FROM revisions WHERE id = ? AND rev <= ? AND chain = 0)
+            ORDER BY rev
+        ''', (identifier, rev, identifier, rev)).fetchall()
+    if not rows or rows[-1]['rev'] != rev:
+        return None
+    content = decode_blob(rows[0]['data'], rows[0]['encoding'])
+    for row in rows[1:]:
+        start, end, text = json.loads(row['data'])
+        content = content[:start] + text + content[end:]
+    return rows[-1], content
+
+# 清理超过保留期的历史版本：每个笔记从最近一个过期的快照开始保留，保证留下的版本都能重建
+def prune_revisions():
+    if not REVISION_RETENTION:
+        return
+    cutoff = int(time.time()) - REVISION_RETENTION
+    for shard in shards:
+        with shard.pool.connection() as conn:
+            conn.execute('''
+                DELETE FROM revisions WHERE rev < (
+                    SELECT MAX(snapshot.rev) FROM revisions AS snapshot
+                    WHERE snapshot.id = revisions.id AND snapshot.chain = 0 AND snapshot.created_at < ?
+                )
+            ''', (cutoff,))
+            conn.commit()
+
+# 将一批写入任务（id -> 内容）提交到数据库，按分片拆分，每个分片一个事务
+def flush_writes(writes):
+    groups = {}
+    for identifier, new_content in writes.items():
+        groups.setdefault(shard_for(identifier), {})[identifier] = new_content
+    for shard, shard_writes in groups.items():
+        flush_shard_writes(shard, shard_writes)
+
+# 将同一分片中的一批写入任务提交到该分片的数据库
+def flush_shard_writes(shard, writes):
+    # 哈希和压缩在写入线程中、进入事务之前完成，请求处理和缓存刷新都不需要等待
+    blob_rows = []
+    content_rows = []
+    revision_rows = []
+    for identifier, new_content in writes.items():
+        digest = content_hash(new_content)
+        blob_rows.append((digest, *encode_blob(new_content)))
+        content_rows.append((identifier, digest))
+        revision_rows.append((identifier, new_content, digest))
+    start = time.perf_counter()
+    with shard.flush_lock:
+        with shard.pool.connection() as conn:
+            # 立即获取写锁，事务期间 change_log 中新增的序号都属于这次写入
+            conn.execute('BEGIN IMMEDIATE')
+            seq_before = get_max_change_seq(conn.cursor())
+            # 历史版本在提交时记录，合并后的一批编辑只产生一个版本
+            record_revisions(conn, revision_rows)
+            conn.executemany('''
+                INSERT INTO blobs (hash, content, encoding) VALUES (?, ?, ?)
+                ON CONFLICT(hash) DO NOTHING
+            ''', blob_rows)
+            conn.executemany('''
+                INSERT INTO contents (id, content_hash) VALUES (?, ?)
+                ON CONFLICT(id) DO UPDATE SET content_hash = excluded.content_hash
+            ''', content_rows)
+            seq_after = get_max_change_seq(conn.cursor())
+            conn.commit()
+        # 已提交的编辑不再是未写入状态（除非期间又有了更新的编辑）
+        with cache_lock:
+            for (identifier, new_content), (_, digest) in zip(writes.items(), content_rows):
+                if pending_writes.get(identifier) is new_content:
+                    del pending_writes[identifier]
+                # 已缓存的条目与提交的内容保持一致（写入队列中还有更新的编辑时保留内存中的版本）
+                if identifier not in pending_writes and identifier in cache['contents']:
+                    cache['contents'][identifier] = (new_content, digest)
+            # 缓存已包含这次写入，之前的修改也都已同步时，刷新无需再把它们读回来
+            if cache['change_seqs'].get(shard.index, 0) == seq_before:
+                cache['change_seqs'][shard.index] = seq_after
+            cache['generation'] += 1
+    metrics.observe('justgetmynote_flush_batch_size', len(writes))
+    metrics.observe('justgetmynote_flush_duration_seconds', time.perf_counter() - start)
+
+# 批量删除已被领取的阅后即焚内容，删除提交后再移除墓碑（每个分片一个删除线程）
+def process_burn_deletes(shard):
+    burn_delete_queue = shard.burn_delete_queue
+    while True:
+        burn_ids = [burn_delete_queue.get()]
+        batch_size = get_setting('write_batch_size')
+        deadline = time.monotonic() + get_setting('write_flush_latency')
+        while len(burn_ids) < batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                burn_ids.append(burn_delete_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        try:
+            flush_burn_deletes(burn_ids)
+        except Exception as e:
+            logger.error(f"Error deleting burn content: {e}")
+            # 稍后重试，期间墓碑仍然阻止这些内容被再次领取
+            time.sleep(1)
+            for burn_id in burn_ids:
+                burn_delete_queue.put(burn_id)
+
+# 删除一批 burn_id，每个分片一个事务
+def flush_burn_deletes(burn_ids):
+    groups = {}
+    for burn_id in burn_ids:
+        groups.setdefault(shard_for(burn_id), []).append(burn_id)
+    deleted = []
+    for shard, shard_burn_ids in groups.items():
+        with shard.flush_lock:
+            with shard.pool.connection() as conn:
+                if DELETE_RETURNING_SUPPORTED:
+                    deleted += [row['burn_id'] for row in fetch_rows_by_keys(conn.cursor(), 'DELETE FROM burn_contents WHERE burn_id IN ({}) RETURNING burn_id', shard_burn_ids)]
+                else:
+                    conn.executemany('DELETE FROM burn_contents WHERE burn_id = ?', [(burn_id,) for burn_id in shard_burn_ids])
+                    deleted += shard_burn_ids
+                conn.commit()
+            with cache_lock:
+                burned_ids.difference_update(shard_burn_ids)
+    for burn_id in deleted:
+        logger.info(f"Burn content {burn_id} deleted after access.")
 
 # 初始化应用程序
 def initialize_app():
     # 初始化数据库和文件
-    init_db()
+    init_databases()
     init_main_txt()
     init_meta()
     init_favicon()
     init_settings()
     init_lib()
+    init_static_assets()
 
     # 初次加载缓存
     try:
-        # 读取 main.txt
-        if os.path.exists(MAIN_TEXT_FILE):
-            with open(MAIN_TEXT_FILE, 'r', encoding='utf-8') as f:
-                cache['main_text'] = f.read()
-        else:
-            cache['main_text'] = ""
-
-        # 读取 settings/main.txt
-        if os.path.exists(MAIN_SETTINGS_FILE):
-            with open(MAIN_SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                settings = {}
-                for line in f:
-                    line = line.strip()
-                    if line.startswith('#') or not line:
-                        continue
-                    if '=' in line:
-                        key, value = line.split('=', 1)
-                        key = key.strip().lower()
-                        value = value.strip().lower()
-                        if key == 'construction':
-                            settings['construction'] = (value == 'true')
-                cache['settings'] = settings
-        else:
-            cache['settings'] = {}
+        # 读取 main.txt 和 settings/main.txt
+        settings_watcher.poll()
 
-        # 加载所有内容到缓存
-        load_all_contents_to_cache()
+        # 笔记内容不再预先全部加载，只记录当前的变更序号，之后按需懒加载
+        reset_content_cache()
     except Exception as e:
         print(f"初始化缓存时出错: {e}")
 
+    # 启动设置监视线程，main.txt 和 settings/main.txt 变化后约 100 毫秒内生效
+    settings_thread = threading.Thread(target=settings_watcher.run, args=(SETTINGS_POLL_INTERVAL,), daemon=True)
+    settings_thread.start()
+
+    # 启动数据库修改监视线程，其他进程的写入立即同步到缓存
+    for shard in shards:
+        data_version_thread = threading.Thread(target=watch_data_version, args=(shard,), daemon=True)
+        data_version_thread.start()
+
     # 启动缓存更新线程
     cache_thread = threading.Thread(target=update_cache, daemon=True)
     cache_thread.start()
 
-    # 启动写入队列处理线程
-    write_thread = threading.Thread(target=process_write_queue, daemon=True)
-    write_thread.start()
+    # 启动各分片的写入队列处理线程和阅后即焚删除线程
+    for shard in shards:
+        write_thread = threading.Thread(target=process_write_queue, args=(shard,), daemon=True)
+        write_thread.start()
+        burn_delete_thread = threading.Thread(target=process_burn_deletes, args=(shard,), daemon=True)
+        burn_delete_thread.start()
+
+    # 启动日志线程
+    log_thread = threading.Thread(target=log_writer.run, daemon=True)
+    log_thread.start()
+    atexit.register(log_writer.drain)
+
+# 命令行导入导出和分片迁移时只需要数据库，不初始化其他文件，也不启动后台线程
+CLI_COMMANDS = ('export', 'import', 'shard')
 
 # 调用初始化函数
-initialize_app()
+if not (__name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS):
+    initialize_app()
+
+# 原生 ASGI 应用：缓存命中的请求直接在事件循环中处理，
+# 需要访问数据库或文件的请求交给有界线程池中的 Flask 应用
+class NoteAsgiApp:
+    def __init__(self, wsgi_app, worker_threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix='asgi-worker')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        start = time.perf_counter()
+        body = await self.read_body(receive)
+        if body is None:
+            await self.send_response(send, 413, [('Content-Type', 'text/plain')], [b'Request Entity Too Large'])
+            return
+        headers = Headers([(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']])
+        client = scope.get('client')
+        remote_addr = client[0] if client else ''
+        if scope['method'] == 'GET' and scope['path'].startswith('/events/'):
+            await self.serve_events(scope, receive, send, headers, remote_addr, start)
+            return
+        try:
+            response = self.handle_from_cache(scope['method'], scope['path'], headers, body, remote_addr)
+        except Exception as e:
+            logger.error(f"ASGI 请求处理出错: {e}")
+            response = Response('Internal Server Error', status=500)
+        if response is not None:
+            duration = time.perf_counter() - start
+            write_access_log(remote_addr, scope['path'], scope['method'], response.status_code, duration)
+            observe_request(scope['path'], scope['method'], response.status_code, duration)
+            await self.send_response(send, response.status_code, response.headers.to_wsgi_list(), response.iter_encoded())
+            return
+        loop = asyncio.get_running_loop()
+        status, response_headers, chunks = await loop.run_in_executor(self.executor, self.run_wsgi, scope, headers, body, remote_addr)
+        await self.send_response(send, status, response_headers, chunks)
+
+    # 只用缓存处理请求，无法处理时返回 None
+    # 受限流的请求在这里取令牌，交给 Flask 处理时不再重复计数
+    def handle_from_cache(self, method, path, headers, body, remote_addr):
+        if method == 'POST':
+            limiter = RATE_LIMITERS.get(route_name(path))
+            if limiter is not None:
+                retry_after = limiter.acquire(remote_addr)
+                if retry_after:
+                    return rate_limited_response(path, retry_after)
+        if method == 'GET':
+            if path.startswith('/lib/'):
+                return static_response(path[len('/lib/'):], headers)
+            if path.startswith('/meta/') or path.startswith('/history/') or path in ('/favicon.ico', '/metrics'):
+                return None
+            return content_response(path[1:], headers, cache_only=True)
+        if method == 'POST' and path.startswith('/update/'):
+            identifier = path[len('/update/'):]
+            if '/' in identifier:
+                return None
+            data = None
+            mimetype = headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if mimetype == 'application/json' or mimetype.endswith('+json'):
+                try:
+                    data = json.loads(body)
+                except ValueError:
+                    data = None
+            result = apply_update(identifier, data, cache_only=True)
+            if result is None:
+                return None
+            payload, status = result
+            return Response(json.dumps(payload), status=status, mimetype='application/json')
+        return None
+
+    # 在事件循环中推送事件流，每个连接只占用一个协程；订阅本身可能需要查询数据库，放到线程池中
+    async def serve_events(self, scope, receive, send, headers, remote_addr, start):
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        known_hash = headers.get('Last-Event-ID') or query.get('hash', [''])[0]
+        notify = lambda: loop.call_soon_threadsafe(wakeup.set)
+        result = await loop.run_in_executor(self.executor, open_event_stream, scope['path'][len('/events/'):], known_hash, notify)
+        status = result.status_code if isinstance(result, Response) else 200
+        duration = time.perf_counter() - start
+        write_access_log(remote_addr, scope['path'], scope['method'], status, duration)
+        observe_request(scope['path'], scope['method'], status, duration)
+        if isinstance(result, Response):
+            await self.send_response(send, result.status_code, result.headers.to_wsgi_list(), result.iter_encoded())
+            return
+        subscriber = result
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            response_headers = [('Content-Type', 'text/event-stream; charset=utf-8')] + list(EVENT_STREAM_HEADERS.items())
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in response_headers],
+            })
+            await send({'type': 'http.response.body', 'body': f'retry: {SSE_RETRY_MS}\n\n'.encode('ascii'), 'more_body': True})
+            while True:
+                waiter = asyncio.ensure_future(wakeup.wait())
+                await asyncio.wait({waiter, disconnected}, timeout=SSE_HEARTBEAT_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiter.cancel()
+                    break
+                if waiter.done():
+                    wakeup.clear()
+                    message = event_hub.take(subscriber)
+                    if message is not None:
+                        await send({'type': 'http.response.body', 'body': message, 'more_body': True})
+                else:
+                    waiter.cancel()
+                    await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+        except OSError:
+            pass
+        finally:
+            disconnected.cancel()
+            event_hub.unsubscribe(subscriber)
+
+    async def wait_disconnect(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    # 在线程池中运行 Flask 应用，返回 (状态码, 响应头, 响应体)
+    def run_wsgi(self, scope, headers, body, remote_addr):
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': remote_addr,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'justgetmynote.admitted': True,
+        }
+        for key, value in headers.items():
+            key = key.upper().replace('-', '_')
+            if key == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif key != 'CONTENT_LENGTH':
+                environ['HTTP_' + key] = value
+        result = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            result['status'] = int(status.split(' ', 1)[0])
+            result['headers'] = response_headers
+
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            chunks = list(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        return result['status'], result['headers'], chunks
+
+    async def read_body(self, receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > ASGI_MAX_BODY_BYTES:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+
+    async def send_response(self, send, status, headers, chunks):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers],
+        })
+        for chunk in chunks:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
 
 # 创建 ASGI 应用程序
-main = WsgiToAsgi(app)
+main = NoteAsgiApp(app, ASGI_WORKER_THREADS)
+
+# 命令行导入导出：python server.py export|import <文件>
+# 以 JSON Lines（.jsonl）或文件打包（.tar）的形式流式导出、导入 contents 和 burn_contents，
+# 文件名以 .gz 结尾时压缩，"-" 表示标准输入或标准输出
+
+# 并行 gzip 写入：数据按块压缩成独立的 gzip 成员并按顺序写出，gzip 工具和 gzip.open 都能直接读取
+# 同时进行中的压缩块数有上限，内存占用与文件大小无关
+class ParallelGzipWriter:
+    def __init__(self, fileobj, jobs):
+        self.fileobj = fileobj
+        self.executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='gzip')
+        self.max_pending = jobs * 2
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= TRANSFER_CHUNK_BYTES:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        chunk = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.executor.submit(gzip.compress, chunk, TRANSFER_COMPRESS_LEVEL, mtime=0))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self._submit()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.fileobj.flush()
+
+# 根据文件名判断格式：返回 ('jsonl' 或 'tar', 是否 gzip 压缩)
+def transfer_format(path, format_name=None):
+    name = path.lower()
+    compressed = name.endswith('.gz') or name.endswith('.tgz')
+    if format_name is None:
+        format_name = 'tar' if name.endswith(('.tar', '.tar.gz', '.tgz')) else 'jsonl'
+    return format_name, compressed
+
+# 按块读取一个分片中的所有笔记和阅后即焚内容，在同一个读事务中完成，导出的是该分片某一时刻的一致快照
+def iter_export_records(conn):
+    conn.execute('BEGIN')
+    cursor = conn.execute('''
+        SELECT c.id, c.share_id, b.content, b.encoding FROM contents c
+        JOIN blobs b ON b.hash = c.content_hash ORDER BY c.id
+    ''')
+    while True:
+        rows = cursor.fetchmany(TRANSFER_BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield {'type': 'note', 'id': row['id'], 'share_id': row['share_id'], 'content': decode_blob(row['content'], row['encoding'])}
+    cursor = conn.execute('''
+        SELECT c.burn_id, b.content, b.encoding FROM burn_contents c
+        JOIN blobs b ON b.hash = c.content_hash ORDER BY c.burn_id
+    ''')
+    while True:
+        rows = cursor.fetchmany(TRANSFER_BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield {'type': 'burn', 'burn_id': row['burn_id'], 'content': decode_blob(row['content'], row['encoding'])}
+    conn.rollback()
+
+# 一条记录编码为一行 JSON；含有单独代理项的内容无法按 UTF-8 输出，改为转义成 \uXXXX
+def encode_jsonl_record(record):
+    line = json.dumps(record, ensure_ascii=False) + '\n'
+    try:
+        return line.encode('utf-8')
+    except UnicodeEncodeError:
+        return (json.dumps(record) + '\n').encode('ascii')
+
+# tar 中笔记保存为 notes/<id>，阅后即焚内容保存为 burns/<burn_id>，share_id 记录在 pax 扩展头中
+def write_tar_record(tar, record):
+    if record['type'] == 'note':
+        info = tarfile.TarInfo('notes/' + record['id'])
+        if record['share_id']:
+            info.pax_headers = {TAR_SHARE_ID_HEADER: record['share_id']}
+    else:
+        info = tarfile.TarInfo('burns/' + record['burn_id'])
+    data = record['content'].encode('utf-8', 'surrogatepass')
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+def export_data(path, format_name=None, jobs=1):
+    format_name, compressed = transfer_format(path, format_name)
+    start = time.perf_counter()
+    counts = {'note': 0, 'burn': 0}
+    out = sys.stdout.buffer if path == '-' else open(path, 'wb')
+    stream = ParallelGzipWriter(out, jobs) if compressed else out
+    tar = tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) if format_name == 'tar' else None
+    try:
+        batch = []
+        for shard in shards:
+            with shard.pool.connection() as conn:
+                for record in iter_export_records(conn):
+                    counts[record['type']] += 1
+                    if tar is not None:
+                        write_tar_record(tar, record)
+                        continue
+                    batch.append(encode_jsonl_record(record))
+                    if len(batch) >= TRANSFER_BATCH_SIZE:
+                        stream.write(b''.join(batch))
+                        batch = []
+        if batch:
+            stream.write(b''.join(batch))
+    finally:
+        if tar is not None:
+            tar.close()
+        if compressed:
+            stream.close()
+        if out is not sys.stdout.buffer:
+            out.close()
+    print(f"已导出 {counts['note']} 篇笔记和 {counts['burn']} 个阅后即焚内容，用时 {time.perf_counter() - start:.2f} 秒。", file=sys.stderr)
+
+# 逐条读取导入文件，返回与导出相同结构的记录
+def iter_import_records(stream, format_name):
+    if format_name == 'tar':
+        with tarfile.open(fileobj=stream, mode='r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                kind, _, key = member.name.partition('/')
+                content = tar.extractfile(member).read().decode('utf-8', 'surrogatepass')
+                if kind == 'notes':
+                    yield {'type': 'note', 'id': key, 'share_id': member.pax_headers.get(TAR_SHARE_ID_HEADER), 'content': content}
+                elif kind == 'burns':
+                    yield {'type': 'burn', 'burn_id': key, 'content': content}
+                else:
+                    yield {'type': None}
+        return
+    for line in io.TextIOWrapper(stream, encoding='utf-8'):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield {'type': None}
+
+# 检查记录是否有效，返回 (表, 键, share_id)，无效时返回 None
+def validate_import_record(record):
+    if not isinstance(record, dict) or not isinstance(record.get('content'), str):
+        return None
+    # 与 /update 相同，不接受超长或含有单独代理项的内容
+    if len(record['content']) > 100000 or not is_valid_text(record['content']):
+        return None
+    if record.get('type') == 'note':
+        identifier, share_id = record.get('id'), record.get('share_id')
+        if not isinstance(identifier, str) or not ID_REGEX.fullmatch(identifier):
+            return None
+        if share_id is not None and (not isinstance(share_id, str) or not SHARE_ID_REGEX.fullmatch(share_id)):
+            return None
+        return 'contents', identifier, share_id
+    if record.get('type') == 'burn':
+        burn_id = record.get('burn_id')
+        if not isinstance(burn_id, str) or not BURN_ID_REGEX.fullmatch(burn_id):
+            return None
+        return 'burn_contents', burn_id, None
+    return None
+
+# 计算一组内容的哈希并压缩，返回 blobs 表的行
+def encode_import_blobs(contents):
+    return [(content_hash(content), *encode_blob(content)) for content in contents]
+
+# 把一批记录写入数据库：内容按线程数分段并行哈希和压缩，再用 executemany 分别写入 blobs、contents 和 burn_contents
+def import_batch(conn, batch, executor, jobs):
+    contents = [content for _, _, _, content in batch]
+    part_size = -(-len(contents) // jobs)
+    parts = [contents[i:i + part_size] for i in range(0, len(contents), part_size)]
+    blob_rows = [row for part in executor.map(encode_import_blobs, parts) for row in part]
+    content_rows = []
+    burn_rows = []
+    for (table, key, share_id, _), (digest, _, _) in zip(batch, blob_rows):
+        if table == 'contents':
+            content_rows.append((key, digest, share_id))
+        else:
+            burn_rows.append((key, digest))
+    conn.executemany('INSERT INTO blobs (hash, content, encoding) VALUES (?, ?, ?) ON CONFLICT(hash) DO NOTHING', blob_rows)
+    conn.executemany('''
+        INSERT INTO contents (id, content_hash, share_id) VALUES (?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET content_hash = excluded.content_hash,
+            share_id = COALESCE(excluded.share_id, contents.share_id)
+    ''', content_rows)
+    conn.executemany('''
+        INSERT INTO burn_contents (burn_id, content_hash) VALUES (?, ?)
+        ON CONFLICT(burn_id) DO UPDATE SET content_hash = excluded.content_hash
+    ''', burn_rows)
+
+# 把一批记录按键分到各分片的连接上写入
+def import_records(conns, batch, executor, jobs):
+    groups = {}
+    for item in batch:
+        groups.setdefault(shard_index(item[1], len(conns)), []).append(item)
+    for index, shard_batch in groups.items():
+        import_batch(conns[index], shard_batch, executor, jobs)
+
+def import_data(path, format_name=None, jobs=1):
+    format_name, compressed = transfer_format(path, format_name)
+    start = time.perf_counter()
+    imported = 0
+    skipped = 0
+    source = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    stream = gzip.open(source, 'rb') if compressed else source
+    try:
+        with ExitStack() as stack, ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='import') as executor:
+            conns = [stack.enter_context(shard.pool.connection()) for shard in shards]
+            # 页缓存的总量不随分片数增加
+            for conn in conns:
+                conn.execute(f'PRAGMA cache_size=-{TRANSFER_CACHE_SIZE_KB // len(conns)}')
+            batch = []
+            for record in iter_import_records(stream, format_name):
+                checked = validate_import_record(record)
+                if checked is None:
+                    skipped += 1
+                    continue
+                batch.append((*checked, record['content']))
+                if len(batch) >= TRANSFER_BATCH_SIZE:
+                    import_records(conns, batch, executor, jobs)
+                    imported += len(batch)
+                    batch = []
+                    # 每批提交一次，导入中途失败时已导入的部分仍然有效
+                    for conn in conns:
+                        conn.commit()
+            if batch:
+                import_records(conns, batch, executor, jobs)
+                imported += len(batch)
+            for conn in conns:
+                conn.commit()
+                conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+    print(f"已导入 {imported} 条记录，跳过 {skipped} 条无效记录，用时 {time.perf_counter() - start:.2f} 秒。", file=sys.stderr)
+
+# 删除数据库文件及其 WAL 文件
+def remove_database_files(path):
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
+
+# 分片迁移：python server.py shard N
+# 把当前布局（DB_SHARDS 个文件）中的笔记、阅后即焚内容和历史版本按键的哈希重新分布到 N 个分片（N 为 1 时合并回 content.db）
+# 先写入 .migrating 临时文件，全部完成后把原文件改名为 .bak，再换上新文件；之后把 DB_SHARDS 改为 N 并重启服务器
+def reshard_data(count):
+    start = time.perf_counter()
+    sources = [shard.database for shard in shards]
+    targets = shard_databases(count)
+    for path in sources + targets:
+        # 服务器仍在运行时它的 WAL 文件不会在 init_db 关闭连接后删除，尚未合并的修改会随改名丢失
+        if os.path.exists(path + '-wal'):
+            print(f"{path} 正在被其他进程使用，请先停止服务器。", file=sys.stderr)
+            return 1
+    for path in sources:
+        if os.path.exists(path + '.bak'):
+            print(f"{path}.bak 已存在，请先移走之前迁移留下的备份。", file=sys.stderr)
+            return 1
+    for path in targets:
+        if path not in sources and os.path.exists(path):
+            print(f"{path} 不属于当前的布局，为避免覆盖其中的数据，请先移走它。", file=sys.stderr)
+            return 1
+    for index, target in enumerate(targets):
+        path = target + '.migrating'
+        remove_database_files(path)
+        with redirect_stdout(sys.stderr):
+            init_db(path, index, count)
+        conn = sqlite3.connect(path)
+        conn.create_function('shard_index', 2, shard_index, deterministic=True)
+        conn.execute(f'PRAGMA cache_size=-{TRANSFER_CACHE_SIZE_KB}')
+        for source in sources:
+            conn.execute('ATTACH DATABASE ? AS source', (source,))
+            # 内容原样复制（不重新压缩），引用计数由 contents、burn_contents 上的触发器重新计算
+            conn.execute('''
+                INSERT INTO blobs (hash, content, encoding)
+                SELECT hash, content, encoding FROM source.blobs WHERE hash IN (
+                    SELECT content_hash FROM source.contents WHERE shard_index(id, ?1) = ?2
+                    UNION SELECT content_hash FROM source.burn_contents WHERE shard_index(burn_id, ?1) = ?2
+                )
+                ON CONFLICT(hash) DO NOTHING
+            ''', (count, index))
+            # init_db 插入的初始笔记以原数据库中的为准
+            conn.execute('''
+                INSERT INTO contents (id, content_hash, share_id)
+                SELECT id, content_hash, share_id FROM source.contents WHERE shard_index(id, ?1) = ?2
+                ON CONFLICT(id) DO UPDATE SET content_hash = excluded.content_hash, share_id = excluded.share_id
+            ''', (count, index))
+            conn.execute('''
+                INSERT INTO burn_contents (burn_id, content_hash)
+                SELECT burn_id, content_hash FROM source.burn_contents WHERE shard_index(burn_id, ?1) = ?2
+            ''', (count, index))
+            conn.execute('''
+                INSERT INTO revisions (id, rev, created_at, content_hash, chain, data, encoding)
+                SELECT id, rev, created_at, content_hash, chain, data, encoding FROM source.revisions WHERE shard_index(id, ?1) = ?2
+            ''', (count, index))
+            conn.commit()
+            conn.execute('DETACH DATABASE source')
+        notes = conn.execute('SELECT COUNT(*) FROM contents').fetchone()[0]
+        burns = conn.execute('SELECT COUNT(*) FROM burn_contents').fetchone()[0]
+        conn.close()
+        print(f"{target}：{notes} 篇笔记，{burns} 个阅后即焚内容。", file=sys.stderr)
+    for path in sources:
+        os.replace(path, path + '.bak')
+    for target in targets:
+        os.replace(target + '.migrating', target)
+    print(f"已迁移到 {count} 个分片，用时 {time.perf_counter() - start:.2f} 秒，原数据库已改名为 .bak。请把 DB_SHARDS 设为 {count} 后重启服务器。", file=sys.stderr)
+    return 0
+
+def run_cli(argv):
+    parser = argparse.ArgumentParser(prog='server.py', description='Import, export or re-shard JustGetMyNote notes and burn-after-read content.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ('export', 'import'):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument('path', help='.jsonl, .jsonl.gz, .tar or .tar.gz file, or - for stdin/stdout (JSON Lines)')
+        subparser.add_argument('--format', choices=('jsonl', 'tar'), help='override the format guessed from the file name')
+        subparser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='threads used to compress or hash content')
+    subparser = subparsers.add_parser('shard', help='move the data of the current DB_SHARDS layout into COUNT shard files')
+    subparser.add_argument('count', type=int, help='number of shards, 1 merges everything back into content.db')
+    args = parser.parse_args(argv)
+    # 导入导出只需要数据库，不启动服务器的其他部分；提示信息输出到标准错误，不混入导出到标准输出的数据
+    with redirect_stdout(sys.stderr):
+        init_databases()
+    if args.command == 'export':
+        export_data(args.path, args.format, max(args.jobs, 1))
+    elif args.command == 'import':
+        import_data(args.path, args.format, max(args.jobs, 1))
+    else:
+        if args.count < 1:
+            parser.error('count must be at least 1')
+        return reshard_data(args.count)
+    return 0
 
 # 启动服务器
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        sys.exit(run_cli(sys.argv[1:]))
     # 启动 Flask 服务器
     app.run(host='0.0.0.0', port=PORT, threaded=True)